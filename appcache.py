@@ -0,0 +1,124 @@
+import json
+import os
+import time
+
+from logzero import logger
+
+import storage
+import terrain
+
+
+CACHE_FILE = "appcache.json"
+DEFAULT_TTL = 60 * 60 * 6
+
+
+class AppCache(object):
+    '''
+    Caches the Terrain app descriptor (app_id, system_id, parameter_id) for
+    each app search string so that plugins don't look the same app up once
+    per file. Entries are kept in memory for the run and saved to disk so the
+    next cron run can reuse them until they expire.
+    '''
+
+    def __init__(self, path=CACHE_FILE, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            logger.error("could not read app cache %s, starting empty: %s" % (self.path, e))
+            self.entries = {}
+
+    def save(self):
+        '''
+        Writes the cache back to disk if anything changed during the run
+        '''
+
+        if not self.path or not self.dirty:
+            return
+        storage.write_json(self.path, self.entries)
+        self.dirty = False
+
+    def get(self, search):
+        entry = self.entries.get(search)
+        if entry is None:
+            return None
+        if time.time() - entry['fetched_at'] > self.ttl:
+            del self.entries[search]
+            self.dirty = True
+            return None
+        return entry
+
+    def put(self, search, entry):
+        entry['fetched_at'] = time.time()
+        self.entries[search] = entry
+        self.dirty = True
+
+    def invalidate(self, search):
+        '''
+        Drops the descriptor for an app, e.g. after Terrain rejected a
+        submission built from it
+        '''
+
+        if self.entries.pop(search, None) is not None:
+            self.dirty = True
+            logger.info("invalidated cached app descriptor for " + search)
+
+    def lookup(self, search, auth_headers):
+        '''
+        Returns the descriptor for the app matching search, asking Terrain
+        only when there is no fresh cached copy
+        '''
+
+        entry = self.get(search)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        entry = fetch_descriptor(search, auth_headers)
+        self.put(search, entry)
+        return entry
+
+    def log_stats(self):
+        logger.info("app cache: %d hits, %d misses, %d entries"
+                    % (self.hits, self.misses, len(self.entries)))
+
+
+def fetch_descriptor(search, auth_headers):
+    '''
+    Looks the app up in Terrain and pulls out the ids needed to submit it
+    '''
+
+    r = terrain.http().get(terrain.url("/apps"), headers=auth_headers, params={"search": search})
+    r.raise_for_status()
+    app_listing = r.json()["apps"][0]
+    system_id = app_listing["system_id"]
+    app_id = app_listing["id"]
+    logger.debug("System ID: " + system_id)
+    logger.debug("App ID: " + app_id)
+
+    r = terrain.http().get(terrain.url("/apps/{0}/{1}".format(system_id, app_id)), headers=auth_headers)
+    r.raise_for_status()
+    parameter_id = r.json()["groups"][0]["parameters"][0]["id"]
+    logger.debug("Parameter ID: " + parameter_id)
+
+    return {
+        'app_id': app_id,
+        'system_id': system_id,
+        'parameter_id': parameter_id
+    }
+
+
+# shared by every plugin in this process
+cache = AppCache()
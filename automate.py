@@ -1,6 +1,7 @@
-from irods.session import iRODSSession
+import argparse
 import os
 import fcntl
+import signal
 import time
 import logzero
 from logzero import logger
@@ -8,38 +9,178 @@ import logging
 
 import getpass
 import pprint
-import requests
 import auth
-from tinydb import TinyDB, Query
-
-
-try:
-
-    if (auth.password == "fix_me"):
-        logger.error("you didn't update the password in auth.py")
-        exit(1)
-    db = TinyDB('db.json')
-    # Setup rotating logfile with 3 rotations, each with a maximum filesize of 1MB:
-    logzero.logfile("verssa-automation.log", maxBytes=1e6, backupCount=3)
-    logzero.loglevel(logging.DEBUG)
-    session = iRODSSession(host='data.cyverse.org', port=1247, user=auth.username,
-                           password=auth.password, zone='iplant')
-    r = requests.get("https://de.cyverse.org/terrain/token", auth=(auth.username, auth.password))
-    r.raise_for_status()
-    token = r.json()['access_token']
-    auth_headers = {"Authorization": "Bearer " + token}
-except Exception as e:
-    logger.exception(e)
-    logger.error("could not setup so we are exiting")
-    exit(-1)
-
-def load_plugin(name):
-    mod = __import__("%s" % name)
-    return mod
+import appcache
+import batching
+import terrain
+import jobstore
+import leases
+import ledger
+import metrics
+import plugins
+import polling
+import relocate
+import scan
+import submit
+
+
+INCOMING_DIR = "/iplant/home/shared/ssa-arizona/demo/incoming"
+COMPLETED_DIR = "/iplant/home/shared/ssa-arizona/demo/data"
+FAILED_DIR = "/iplant/home/shared/ssa-arizona/demo/failed"
+
+# daemon mode: seconds between runs of each phase
+PHASE_INTERVALS = {
+    'update': 60,
+    'move-completed': 120,
+    'move-failed': 120,
+    'scan-incoming': 30,
+}
+
+WATERMARK_FILE = "incoming-watermark.json"
+LOG_FILE = "verssa-automation.log"
+# worker mode: most new files one worker takes from /incoming per scan, so
+# a large drop is spread over every worker
+CLAIM_LIMIT = 200
+
+session = None
+db = None
+tokens = None
+auth_headers = {}
+stopping = False
+# None lets the scan decide; True forces a full rescan of /incoming
+full_scan = None
+# worker mode (--worker): a leases.Leases kept with the job store instead of
+# the single-instance lock
+worker_leases = None
+# relocate.SessionPool of extra connections for moving finished data
+move_pool = None
+# --metrics: directory the Prometheus textfile and run summary go to
+metrics_dir = None
+
+
+def setup():
+    '''
+    Opens the log and prepares the Terrain token. The job store, the iRODS
+    session and the token itself are only set up once a phase needs them
+    (get_db, get_session, get_auth_headers), so an idle run touches none of
+    them. Called once per process, so the daemon keeps all of them alive.
+    '''
+
+    global tokens, auth_headers
+
+    try:
+
+        if (auth.password == "fix_me"):
+            logger.error("you didn't update the password in auth.py")
+            exit(1)
+        # Setup rotating logfile with 3 rotations, each with a maximum filesize of 1MB:
+        logzero.logfile(LOG_FILE, maxBytes=1e6, backupCount=3)
+        logzero.loglevel(logging.DEBUG)
+        # job lifecycle events for `python ledger.py report`
+        ledger.enable(ledger.LEDGER_DIR)
+        tokens = terrain.TokenManager(auth.username, auth.password,
+                                      cache_path=terrain.TOKEN_FILE)
+        # filled in by get_auth_headers() and kept current in place
+        auth_headers = tokens.headers
+    except Exception as e:
+        logger.exception(e)
+        logger.error("could not setup so we are exiting")
+        exit(-1)
+
+
+def get_db():
+    global db
+    if db is None:
+        db = jobstore.open_store(database())
+    return db
+
+
+def database():
+    '''
+    Where the job store and leases live: the shared PostgreSQL database if
+    auth.py names one, otherwise the local SQLite file
+    '''
+
+    return getattr(auth, 'database_url', None) or jobstore.STORE_FILE
+
+
+def get_session():
+    global session
+    if session is None:
+        session = open_session()
+    return session
+
+
+def get_auth_headers():
+    '''
+    Headers for Terrain calls, logging in first if the saved token is
+    missing or about to expire
+    '''
+
+    return tokens.ensure_fresh()
+
+
+def open_session():
+    from irods.session import iRODSSession
+    return metrics.instrument_irods(iRODSSession(host='data.cyverse.org', port=1247,
+                                                 user=auth.username, password=auth.password,
+                                                 zone='iplant'))
+
+
+def start_worker(name):
+    '''
+    Switches to worker mode: several processes split the work by claiming
+    items with leases kept next to the job store. They run on one host, or
+    on any number of hosts with a PostgreSQL database_url.
+    '''
+
+    global worker_leases, WATERMARK_FILE, LOG_FILE
+    owner = leases.worker_owner(name or None)
+    try:
+        worker_leases = leases.Leases(database(), owner)
+    except RuntimeError as e:
+        logger.error(e)
+        exit(-1)
+    # each worker scans on its own schedule and logs to its own file
+    label = owner.split(":")[0]
+    WATERMARK_FILE = "incoming-watermark-%s.json" % label
+    LOG_FILE = "verssa-automation-%s.log" % label
+    logger.info("running as worker " + owner)
+
+
+def claim(kind, keys, limit=None):
+    '''
+    The keys this process may work on: all of them in single-instance mode,
+    otherwise the ones it won a lease on
+    '''
+
+    if worker_leases is None:
+        return list(keys)
+    prefix = kind + ":"
+    won = worker_leases.claim([prefix + key for key in keys], limit)
+    return [key[len(prefix):] for key in won]
+
+
+def release(kind, keys):
+    if worker_leases is not None:
+        worker_leases.release([kind + ":" + key for key in keys])
+
+
+def acquire_instance():
+    if worker_leases is not None:
+        return
+    if not prog_lock_acq('singleton.lock'):
+        logger.error("There was another instance running")
+        exit(-1)
+
 
 def call_plugin(name, *args, **kwargs):
-    plugin = load_plugin(name)
-    plugin.plugin_main(*args, **kwargs)
+    '''
+    Runs the handler registered for file type name (see plugins.py)
+    '''
+
+    with metrics.timer('verssa_plugin_seconds', plugin=name):
+        return plugins.call(name, *args, **kwargs)
 
 
 def main():
@@ -52,98 +193,286 @@ def main():
     run projects on
     '''
 
-    if not prog_lock_acq('singleton.lock'):
-        logger.error("There was another instance running")
-        exit(-1)
+    acquire_instance()
 
-    entry = Query()
-    result = db.search((entry.status == "Submitted") | (entry.status == "Running"))
-    if (len(result) > 0):
-        updateRunningData(result)
+    start = time.time()
+    checkRunning()
+    checkCompleted()
+    checkFailed()
+    scanIncoming()
+    logger.debug("run took %.2fs" % (time.time() - start))
 
-    result = db.search(entry.status == "Completed")
-    if (len(result) > 0):
-        moveCompletedData(result)
-    
-    result = db.search(entry.status == "Failed")
+    if metrics_dir is not None:
+        metrics.write(metrics_dir)
+
+
+def daemon():
+    '''
+    Runs the phases in a loop, each on its own interval from
+    PHASE_INTERVALS, reusing the same session, token and connection pool.
+    The token is renewed before it expires. Stops on SIGTERM or SIGINT.
+    '''
+
+    acquire_instance()
+
+    def stop(signum, frame):
+        global stopping
+        logger.info("got signal %d, stopping after the current phase" % signum)
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    phases = [
+        ('update', checkRunning),
+        ('move-completed', checkCompleted),
+        ('move-failed', checkFailed),
+        ('scan-incoming', scanIncoming),
+    ]
+    next_run = dict((name, 0) for name, _ in phases)
+
+    logger.info("starting daemon")
+    while not stopping:
+        for name, phase in phases:
+            if stopping or time.time() < next_run[name]:
+                continue
+            try:
+                phase()
+            except Exception as e:
+                logger.exception(e)
+            next_run[name] = time.time() + PHASE_INTERVALS[name]
+            if metrics_dir is not None:
+                metrics.write(metrics_dir)
+
+        while not stopping and time.time() < min(next_run.values()):
+            time.sleep(1)
+
+    appcache.cache.save()
+    logger.info("daemon stopped")
+
+
+def checkRunning():
+    db = get_db()
+    result = polling.due_jobs(db, time.time())
     if (len(result) > 0):
-        moveFailedData(result)
+        ids = claim("poll", sorted(set(x['id'] for x in result)))
+        # poll every file of a batch analysis together so they finish together
+        result = [x for x in db.by_ids(ids) if x['status'] in ("Submitted", "Running")]
+        if worker_leases is not None:
+            # read after claiming, so a poll another worker just did isn't repeated
+            now = time.time()
+            due = set(x['id'] for x in result if (x['next_poll_at'] or 0) <= now)
+            result = [x for x in result if x['id'] in due]
+        try:
+            if (len(result) > 0):
+                updateRunningData(result)
+        finally:
+            release("poll", ids)
 
-    if session is None:
-        logger.error("There was an error creating the cyverse session")
-        exit(-1)
 
-    coll = session.collections.get("/iplant/home/shared/ssa-arizona/demo/incoming")
+def claimed_rows(kind, status):
+    '''
+    Rows with status; in worker mode only those this process won leases
+    on, read again after claiming
+    '''
+
+    db = get_db()
+    result = db.search_status(status)
+    if worker_leases is None:
+        return result
+    names = claim(kind, [x['name'] for x in result])
+    return [x for x in (db.get(name) for name in names) if x is not None and x['status'] == status]
 
-    for obj in coll.data_objects:
-        logger.debug(obj)
-        ftype = obj.name.split(".")[-1]
-        logger.debug(ftype)
 
-        entry = Query()
-        result = db.search(entry.name == obj.path)
-        if (len(result)) > 0:
+def movable(result, now):
+    return [x for x in result if (x.get('move_after') or 0) <= now]
+
+
+def checkCompleted():
+    result = movable(claimed_rows("move", "Completed"), time.time())
+    try:
+        if (len(result) > 0):
+            moveCompletedData(result)
+    finally:
+        release("move", [x['name'] for x in result])
+
+
+def checkFailed():
+    result = movable(claimed_rows("move", "Failed"), time.time())
+    try:
+        if (len(result) > 0):
+            moveFailedData(result)
+    finally:
+        release("move", [x['name'] for x in result])
+
+
+@metrics.timed('scanIncoming')
+def scanIncoming():
+    '''
+    Looks for new data files in /incoming and runs the matching module on
+    each one that hasn't been submitted yet. The modules hand back their
+    analysis requests, which are then posted concurrently. Files of batched
+    types wait as 'Pending' until their batch is full or its window is up.
+
+    Only files changed since the last scan are listed, with a full rescan
+    every scan.FULL_SCAN_INTERVAL. The watermark only moves forward when
+    every file's module ran and every submission went through.
+
+    In worker mode each worker claims up to CLAIM_LIMIT of the new files
+    and leaves the rest to the others.
+    '''
+
+    db = get_db()
+    scanner = scan.DeltaScan(get_session(), INCOMING_DIR, scan.Watermarks(WATERMARK_FILE),
+                             full=full_scan)
+
+    submitted = db.names()
+    new = []
+    unsupported = {}
+    for obj in scanner:
+        logger.debug(obj)
+        if obj.path in submitted:
             logger.info("Skipping " + obj.name + " because it's already been submitted")
             continue
+        ftype = obj.name.split(".")[-1]
+        if not plugins.supported(ftype):
+            unsupported[ftype] = unsupported.get(ftype, 0) + 1
+            continue
+        new.append(obj)
+    for ftype, count in unsupported.items():
+        logger.warning("no module for .%s files, skipped %d" % (ftype, count))
 
-        v = dict(obj=obj, db=db, auth_headers=auth_headers, logger=logger)
-        call_plugin(ftype, v)
+    if len(new) == 0 and len(db.search_status('Pending')) == 0:
+        # nothing to submit, so no need for a Terrain token
+        scanner.commit()
+        return
+    auth_headers = get_auth_headers()
 
+    claimed = claim("incoming", [obj.path for obj in new], CLAIM_LIMIT)
+    mine = set(claimed)
+    submissions = []
+    parked = []
+    plugin_failed = 0
+    try:
+        seen_at = time.time()
+        for obj in new:
+            if obj.path not in mine:
+                continue
+            # another worker may have submitted it between the listing and the claim
+            if worker_leases is not None and db.get(obj.path) is not None:
+                continue
+            ledger.record_many([('arrived', obj.path, obj.modify_time), ('seen', obj.path, seen_at)])
+
+            ftype = obj.name.split(".")[-1]
+            logger.debug(ftype)
+            v = dict(obj=obj, db=db, auth_headers=auth_headers, logger=logger, defer=True)
+            try:
+                submission = call_plugin(ftype, v)
+            except Exception as e:
+                plugin_failed += 1
+                logger.error("could not build the analysis for " + obj.name)
+                logger.exception(e)
+                continue
+            # modules that don't know about defer post the analysis themselves,
+            # and only log their errors, so check the job got recorded
+            if submission is None:
+                if db.get(obj.path) is None:
+                    plugin_failed += 1
+                continue
+            if batching.is_batched(ftype):
+                parked.append((ftype, submission))
+            else:
+                submissions.append(submission)
+
+        now = time.time()
+        batching.park(parked, db, now)
+        # only one worker at a time merges the waiting files into batches
+        merging = claim("batching", ["ready"])
+        try:
+            if len(merging) > 0:
+                submissions.extend(batching.ready_batches(db, now))
+            _, failed = submit.submit_all(submissions, auth_headers, db)
+        finally:
+            release("batching", merging)
+    finally:
+        release("incoming", claimed)
+
+    # files left to other workers (or to a later scan) keep the watermark back
+    if failed == 0 and plugin_failed == 0 and len(claimed) == len(new):
+        scanner.commit()
+
+    appcache.cache.log_stats()
+    appcache.cache.save()
+
+
+@metrics.timed('updateRunningData')
 def updateRunningData(result):
     '''
     Takes a list of currently unfinished apps and checks if they are finished
+
+    Statuses are fetched in batches and every change is written back to the
+    db in a single write. Each job gets its next poll time from the polling
+    schedule; jobs whose status couldn't be fetched back off.
     '''
 
+    statuses = terrain.fetch_statuses(set(x['id'] for x in result), get_auth_headers())
+
+    now = time.time()
+    changed = []
     for x in result:
-        try:
-            logger.debug(x['id'])
-            r = requests.get("https://de.cyverse.org/terrain/analyses/{0}/history"
-                             .format(x['id']), headers=auth_headers)
-            r.raise_for_status()
-            logger.debug(r.json())
+        newStatus = statuses.get(x['id'])
+        if newStatus is None:
+            polling.schedule_error(x, now)
+            logger.debug("no status for %s, %d errors in a row" % (x['id'], x['poll_errors']))
+            continue
+        if newStatus != x['status']:
+            logger.debug(x['id'] + " is now " + newStatus)
+            if newStatus.lower() in ledger.CODES:
+                changed.append((newStatus.lower(), x['name'], now))
+        polling.schedule_success(x, newStatus, now)
 
-            newStatus = (r.json()['steps'][0]['status'])
-            entry = Query()
-            db.update({'status': newStatus}, entry.name == x['name'])
-        except Exception as e:
-            logger.exception(e)
+    get_db().write_back(result)
+    ledger.record_many(changed)
 
 
+@metrics.timed('moveCompletedData')
 def moveCompletedData(result):
     '''
     Takes a list of completed apps and attempts to move their data file
     '''
 
-    for x in result:
-        try:
-            session.data_objects.move(x['name'], '/iplant/home/shared/ssa-arizona/demo/data')
-            entry = Query()
-            db.remove(entry.name == x['name'])
-            logger.info("We moved " + x['name'] + " into the completed directory.")
-        except Exception as e:
-            if "irods.exception" in (str(type(e))):
-                logger.error("Ran into a custom irods exception when trying to move a file,"
-                             " probably a permissions issue")
-            else:
-                logger.exception(e)
+    relocateData(result, COMPLETED_DIR)
 
+
+@metrics.timed('moveFailedData')
 def moveFailedData(result):
     '''
-    Takes a list of completed apps and attempts to move their data file
+    Takes a list of failed apps and attempts to move their data file
     '''
 
-    for x in result:
-        try:
-            session.data_objects.move(x['name'], '/iplant/home/shared/ssa-arizona/demo/failed')
-            entry = Query()
-            db.remove(entry.name == x['name'])
-            logger.info("We moved " + x['name'] + " into the failed directory.")
-        except Exception as e:
-            if "irods.exception" in (str(type(e))):
-                logger.error("Ran into a custom irods exception when trying to move a file,"
-                             " probably a permissions issue")
-            else:
-                logger.exception(e)
+    relocateData(result, FAILED_DIR)
+
+
+def relocateData(result, dest):
+    '''
+    Moves the data files concurrently over a small pool of iRODS
+    connections, then drops every moved job from the db in one write. Files
+    we have no permission to move are set aside for relocate.DENIED_RETRY
+    instead of being tried again each cycle.
+    '''
+
+    global move_pool
+    if move_pool is None:
+        move_pool = relocate.SessionPool(open_session)
+
+    moved, denied, _ = relocate.move_all([x['name'] for x in result], dest, move_pool)
+    retry_at = time.time() + relocate.DENIED_RETRY
+    db = get_db()
+    with db.batch():
+        db.remove(moved)
+        db.write_back([{'name': name, 'move_after': retry_at} for name in denied])
+    ledger.record_many([('moved', name, None) for name in moved])
+
 
 def prog_lock_acq(lpath):
     '''
@@ -162,4 +491,29 @@ def prog_lock_acq(lpath):
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Run CyVerse apps on files uploaded to /incoming")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and repeat each phase on its own interval")
+    parser.add_argument("--full-scan", action="store_true",
+                        help="list all of /incoming instead of only files changed since the last scan")
+    parser.add_argument("--worker", nargs="?", const="", metavar="NAME",
+                        help="share the work with other workers through leases next to the job"
+                             " store instead of running as the only instance (other hosts too"
+                             " with a PostgreSQL database_url in auth.py)")
+    parser.add_argument("--metrics", metavar="DIR",
+                        help="time each phase, plugin and Terrain/iRODS call and write a"
+                             " Prometheus textfile and a JSON summary to DIR")
+    args = parser.parse_args()
+    if args.full_scan:
+        full_scan = True
+    if args.metrics:
+        metrics_dir = args.metrics
+        metrics.enable('automate')
+
+    if args.worker is not None:
+        start_worker(args.worker)
+    setup()
+    if args.daemon:
+        daemon()
+    else:
+        main()
@@ -0,0 +1,93 @@
+import copy
+import json
+import uuid
+
+from logzero import logger
+
+import submit
+
+
+# opt-in per file type: up to size files go into one analysis, and a
+# partial batch is submitted once its oldest file has waited window seconds.
+# The type's app must take a list of paths in the input parameter.
+BATCH_TYPES = {
+    # 'qmg': {'size': 25, 'window': 10 * 60},
+}
+
+
+def is_batched(ftype):
+    return ftype in BATCH_TYPES
+
+
+def park(pending, db, now):
+    '''
+    Records files of batched types as 'Pending' along with the request their
+    module built, until their batch is ready. pending is a list of
+    (ftype, Submission) pairs.
+    '''
+
+    if len(pending) == 0:
+        return
+    db.insert_many([{
+        'name': submission.name,
+        'status': 'Pending',
+        'ftype': ftype,
+        'submitted_at': now,
+        'request': json.dumps({'search': submission.search, 'body': submission.body}),
+    } for ftype, submission in pending])
+    logger.info("%d files waiting for a batch" % len(pending))
+
+
+def ready_batches(db, now):
+    '''
+    Submissions for every batch that is full or whose window has run out
+    '''
+
+    by_type = {}
+    for row in db.search_status('Pending'):
+        by_type.setdefault(row['ftype'], []).append(row)
+
+    batches = []
+    for ftype, rows in by_type.items():
+        # a type that was taken out of BATCH_TYPES drains one file at a time,
+        # each with the request its module built
+        config = BATCH_TYPES.get(ftype, {'size': 1, 'window': 0})
+        rows.sort(key=lambda row: row['submitted_at'])
+        while len(rows) > 0:
+            if len(rows) < config['size'] and now - rows[0]['submitted_at'] < config['window']:
+                break
+            if is_batched(ftype):
+                batches.append(merge(ftype, rows[:config['size']], now))
+            else:
+                batches.append(unbatched(rows[0]))
+            rows = rows[config['size']:]
+    return batches
+
+
+def unbatched(row):
+    '''
+    The request a module built for row, submitted as it is: the type's app
+    no longer takes a list, so it must get the single path
+    '''
+
+    request = json.loads(row['request'])
+    return submit.Submission(row['name'], request['search'], request['body'])
+
+
+def merge(ftype, rows, now):
+    '''
+    One submission for all rows: the first file's request with its input
+    parameter replaced by the list of every member's path
+    '''
+
+    request = json.loads(rows[0]['request'])
+    body = copy.deepcopy(request['body'])
+    members = [row['name'] for row in rows]
+    for key, value in body['config'].items():
+        if value == rows[0]['name']:
+            body['config'][key] = members
+    body['name'] = body['name'] + "Batch"
+
+    name = "%s-batch-%d-%s" % (ftype, int(now), uuid.uuid4().hex[:8])
+    logger.info("batch %s has %d files" % (name, len(members)))
+    return submit.Submission(name, request['search'], body, members)
@@ -0,0 +1,308 @@
+import io
+import itertools
+import operator
+import posixpath
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+OPERATORS = {
+    '=': operator.eq,
+    '<>': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class FakeMetadata(object):
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.avus = []
+
+    def get_all(self, name):
+        self.obj.store.count("metadata.get_all")
+        return [value for key, value in self.avus if key == name]
+
+    def add(self, name, value):
+        self.obj.store.count("metadata.add")
+        self.avus.append((name, value))
+
+    def apply_atomic_operations(self, *operations):
+        self.obj.store.count("metadata.apply_atomic_operations")
+        for op in operations:
+            self.avus.append((op.avu.name, op.avu.value))
+
+
+class FakeDataObject(object):
+
+    def __init__(self, store, path, content=b"", checksum=None):
+        self.store = store
+        self.id = next(store.ids)
+        self.modify_time = datetime.utcfromtimestamp(int(time.time()))
+        self.path = path
+        self.name = posixpath.basename(path)
+        self.content = content
+        self.size = len(content)
+        self.checksum = checksum
+        self.metadata = FakeMetadata(self)
+
+    def open(self, mode='r'):
+        self.store.count("data_object.open")
+        if 'w' in mode:
+            return FakeWriter(self)
+        return io.BytesIO(self.content)
+
+    def __repr__(self):
+        return "<FakeDataObject %s>" % self.path
+
+
+class FakeWriter(io.BytesIO):
+
+    def __init__(self, obj):
+        io.BytesIO.__init__(self)
+        self.obj = obj
+
+    def close(self):
+        self.obj.content = self.getvalue()
+        self.obj.size = len(self.obj.content)
+        io.BytesIO.close(self)
+
+
+class FakeCollection(object):
+
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self.name = posixpath.basename(path)
+
+    @property
+    def data_objects(self):
+        self.store.count("collection.data_objects")
+        return self.store.objects_in(self.path)
+
+    @property
+    def subcollections(self):
+        self.store.count("collection.subcollections")
+        return [FakeCollection(self.store, p) for p in self.store.subcollections_of(self.path)]
+
+    def __str__(self):
+        return "<FakeCollection %s>" % self.path
+
+
+class FakeDataObjects(object):
+
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, path):
+        self.store.count("data_objects.get")
+        return self.store.objects[path]
+
+    def open(self, path, mode='r'):
+        return self.store.objects[path].open(mode)
+
+    def create(self, path):
+        self.store.count("data_objects.create")
+        return self.store.add(path, b"")
+
+    def move(self, src, dest):
+        self.store.count("data_objects.move")
+        if src in self.store.denied:
+            from irods.exception import CAT_NO_ACCESS_PERMISSION
+            raise CAT_NO_ACCESS_PERMISSION(src)
+        self.store.move(src, dest)
+
+
+class FakeCollections(object):
+
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, path):
+        self.store.count("collections.get")
+        return FakeCollection(self.store, path)
+
+
+class FakeQuery(object):
+    '''
+    Evaluates GenQuery filters over the in-memory objects. Supports the
+    DataObject, Collection and DataObjectMeta columns the scripts ask for
+    with =, <>, <, <=, >, >= and like.
+    '''
+
+    def __init__(self, store, columns):
+        self.store = store
+        self.columns = columns
+        self.criteria = []
+        self.ordering = []
+
+    def filter(self, *criteria):
+        self.criteria.extend(criteria)
+        return self
+
+    def order_by(self, column, order="asc"):
+        self.ordering.append(column)
+        return self
+
+    def matches(self, criterion, row):
+        value = row[criterion.query_key]
+        if criterion.op == 'like':
+            pattern = re.escape(criterion.value).replace('%', '.*').replace('_', '.')
+            return re.match(pattern + '$', value) is not None
+        return OPERATORS[criterion.op](self.store.collated(value), self.store.collated(criterion.value))
+
+    def get_batches(self, page_size=500):
+        from irods.models import Collection, DataObject, DataObjectMeta
+        self.store.count("query")
+        meta_columns = (DataObjectMeta.name, DataObjectMeta.value)
+        keys = list(self.columns) + [c.query_key for c in self.criteria]
+        uses_meta = any(key is column for key in keys for column in meta_columns)
+
+        with self.store.lock:
+            objects = list(self.store.objects.values())
+
+        matched = []
+        for obj in objects:
+            base = {
+                Collection.name: posixpath.dirname(obj.path),
+                DataObject.name: obj.name,
+                DataObject.id: obj.id,
+                DataObject.modify_time: obj.modify_time,
+                DataObject.checksum: obj.checksum,
+                DataObject.size: obj.size,
+            }
+            candidates = [base]
+            if uses_meta:
+                candidates = []
+                for name, value in obj.metadata.avus:
+                    row = dict(base)
+                    row[DataObjectMeta.name] = name
+                    row[DataObjectMeta.value] = value
+                    candidates.append(row)
+            for row in candidates:
+                if all(self.matches(c, row) for c in self.criteria):
+                    matched.append(row)
+
+        if len(self.ordering) > 0:
+            matched.sort(key=lambda row: tuple(self.store.collated(row[column])
+                                               for column in self.ordering))
+        for i in range(0, len(matched), page_size):
+            self.store.count("query page")
+            yield matched[i:i + page_size]
+
+
+class FakeMetadataManager(object):
+    '''
+    session.metadata: path based AVU calls
+    '''
+
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, model_cls, path):
+        from irods.meta import iRODSMeta
+        self.store.count("metadata.get")
+        return [iRODSMeta(k, v) for k, v in self.store.objects[path].metadata.avus]
+
+    def add(self, model_cls, path, meta):
+        self.store.count("metadata.add")
+        self.store.objects[path].metadata.avus.append((meta.name, meta.value))
+
+    def apply_atomic_operations(self, model_cls, path, *operations):
+        self.store.count("metadata.apply_atomic_operations")
+        avus = self.store.objects[path].metadata.avus
+        for op in operations:
+            avus.append((op.avu.name, op.avu.value))
+
+
+class FakeStore(object):
+    '''
+    In-memory object tree shared by every FakeSession, counting each call
+    the way a real iRODS round-trip would be counted
+    '''
+
+    def __init__(self, latency=0.0, collate=None):
+        self.objects = {}
+        # sort key standing in for the catalog database's string collation
+        # in comparisons and ORDER BY; None is plain codepoint order
+        self.collate = collate
+        self.calls = Counter()
+        self.ids = itertools.count(10000)
+        self.lock = threading.RLock()
+        # seconds each call takes, standing in for the network round-trip
+        self.latency = latency
+        # paths whose move fails with CAT_NO_ACCESS_PERMISSION
+        self.denied = set()
+
+    def collated(self, value):
+        if self.collate is not None and isinstance(value, str):
+            return self.collate(value)
+        return value
+
+    def count(self, op):
+        with self.lock:
+            self.calls[op] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def reset_counts(self):
+        with self.lock:
+            counts = dict(self.calls)
+            self.calls.clear()
+        return counts
+
+    def add(self, path, content=b"", checksum=None):
+        with self.lock:
+            obj = FakeDataObject(self, path, content, checksum)
+            self.objects[path] = obj
+            return obj
+
+    def move(self, src, dest):
+        with self.lock:
+            obj = self.objects.pop(src)
+            obj.path = posixpath.join(dest, obj.name)
+            self.objects[obj.path] = obj
+
+    def objects_in(self, coll_path):
+        with self.lock:
+            return [o for o in self.objects.values() if posixpath.dirname(o.path) == coll_path]
+
+    def subcollections_of(self, coll_path):
+        with self.lock:
+            subs = set()
+            prefix = coll_path.rstrip("/") + "/"
+            for path in self.objects:
+                if path.startswith(prefix):
+                    rest = path[len(prefix):]
+                    if "/" in rest:
+                        subs.add(prefix + rest.split("/", 1)[0])
+            return sorted(subs)
+
+
+class FakeSession(object):
+    '''
+    Enough of iRODSSession for automate.py and validation.py
+    '''
+
+    def __init__(self, store):
+        self.store = store
+        self.collections = FakeCollections(store)
+        self.data_objects = FakeDataObjects(store)
+        self.metadata = FakeMetadataManager(store)
+
+    def query(self, *columns):
+        return FakeQuery(self.store, columns)
+
+    def cleanup(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
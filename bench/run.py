@@ -0,0 +1,271 @@
+'''
+Offline benchmark for automate.py and validation.py.
+
+Runs every phase against a local Terrain stub and an in-memory iRODS
+stand-in and reports wall time, request counts and peak memory per phase:
+
+    python bench/run.py --incoming 1000 --running 1000 --fits 1000
+    python bench/run.py --json before.json
+    python bench/run.py --compare before.json
+'''
+
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import synth
+from fake_irods import FakeStore, FakeSession
+from stub_terrain import StubTerrain
+
+
+class Recorder(object):
+
+    def __init__(self, terrain, store, track_memory=True):
+        self.terrain = terrain
+        self.store = store
+        self.track_memory = track_memory
+        self.phases = []
+
+    def measure(self, suite, name, fn, *args):
+        self.terrain.reset_counts()
+        self.store.reset_counts()
+        if self.track_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        fn(*args)
+        wall = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if self.track_memory else 0
+        self.phases.append({
+            'suite': suite,
+            'phase': name,
+            'wall_s': round(wall, 4),
+            'http': self.terrain.reset_counts(),
+            'irods': self.store.reset_counts(),
+            'peak_kib': peak // 1024,
+        })
+
+
+def bench_automate(args, terrain, store, recorder):
+    import auth
+    import terrain as terrain_api
+    auth.password = "bench"
+    terrain_api.BASE_URL = terrain.url
+
+    import automate
+    import logzero
+    import submit
+    submit.SUBMIT_RATE = args.submit_rate
+    submit.SUBMIT_BURST = max(1, int(args.submit_rate))
+    if args.batch_size > 1:
+        import batching
+        for ftype in synth.INCOMING_TYPES:
+            batching.BATCH_TYPES[ftype] = {'size': args.batch_size, 'window': 0}
+    import metrics
+    automate.open_session = lambda: metrics.instrument_irods(FakeSession(store))
+    automate.setup()
+    logzero.loglevel(logging.WARNING)
+
+    rng = random.Random(args.seed)
+    for i in range(args.running):
+        path = "%s/running%06d.qmg" % (automate.INCOMING_DIR, i)
+        store.add(path, b"x" * 64)
+        automate.get_db().insert({'name': path, 'id': terrain.add_job('Running'), 'status': 'Running'})
+        if rng.random() < args.move_denied_ratio:
+            store.denied.add(path)
+    synth.populate_incoming(store, automate.INCOMING_DIR, args.incoming, seed=args.seed)
+
+    recorder.measure('automate', 'updateRunningData', automate.checkRunning)
+    recorder.measure('automate', 'moveCompletedData', automate.checkCompleted)
+    recorder.measure('automate', 'moveFailedData', automate.checkFailed)
+    recorder.measure('automate', 'scanIncoming', automate.scanIncoming)
+
+
+def bench_validation(args, terrain, store, recorder):
+    import validation
+    import logzero
+    logzero.loglevel(logging.WARNING)
+
+    synth.populate_validation(store, validation.VALIDATION_ROOT, args.fits,
+                              validated_ratio=args.validated_ratio,
+                              duplicate_ratio=args.duplicate_ratio,
+                              corrupt_ratio=args.corrupt_ratio, seed=args.seed)
+    import metrics
+    session = metrics.instrument_irods(FakeSession(store))
+    validation.open_session = lambda: session
+    validation.worker_session = lambda: session
+    validation.t_end = float("inf")
+    validation.CHECK_INTEGRITY = args.integrity
+    if not args.no_cache:
+        import vcache
+        validation.result_cache = vcache.ValidationCache(vcache.CACHE_FILE,
+                                                         version=validation.cache_version())
+
+    import scan
+    scanner = scan.DeltaScan(session, validation.VALIDATION_ROOT,
+                             scan.Watermarks("validation-watermark.json"), recursive=True, full=True)
+    found = []
+    recorder.measure('validation', 'candidates',
+                     lambda: found.extend(validation.candidates(session, scanner)))
+
+    def validate():
+        for obj in found:
+            result = validation.cached_result(obj) or validation.validate_object(session, obj)
+            validation.collect(result, obj, session)
+
+    recorder.measure('validation', 'validate', validate)
+    recorder.measure('validation', 'metadata flush', validation.metadata_writer.flush)
+
+
+def startup(statement):
+    '''
+    Runs statement in a fresh interpreter from the repo root; returns its
+    peak RSS in KiB. ru_maxrss isn't used: Linux carries it over from the
+    parent across fork and exec, so it would report the bench's own size.
+    '''
+
+    code = statement + ("; print([line.split()[1] for line in open('/proc/self/status')"
+                        " if line.startswith('VmHWM:')][0])")
+    out = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(HERE))
+    return int(out.split()[-1])
+
+
+def bench_headers(args, terrain, store, recorder):
+    '''
+    Built-in header parser against astropy: interpreter startup with each
+    imported, then parsing args.fits primary headers
+    '''
+
+    import io
+    import fitsstream
+
+    for name, statement in [('startup fitsstream', "import fitsstream"),
+                            ('startup astropy', "from astropy.io import fits")]:
+        rss = []
+        recorder.measure('headers', name, lambda: rss.append(startup(statement)))
+        recorder.phases[-1]['rss_kib'] = rss[0]
+
+    rng = random.Random(args.seed)
+    files = [synth.fits_bytes(synth.VALID_HEADER + [("FRAMENO", i)]) if rng.random() > 0.1
+             else synth.fits_bytes(synth.broken_header(rng)) for i in range(args.fits)]
+
+    def parse_builtin():
+        for data in files:
+            fitsstream.read_primary_header(io.BytesIO(data))
+
+    def parse_astropy():
+        for data in files:
+            with fits.open(io.BytesIO(data)) as hdul:
+                hdul[0].header.copy()
+
+    from astropy.io import fits
+    recorder.measure('headers', 'parse fitsstream', parse_builtin)
+    recorder.measure('headers', 'parse fits.open', parse_astropy)
+
+
+def print_report(phases, previous=None):
+    before = {}
+    for p in previous or []:
+        before[(p['suite'], p['phase'])] = p
+
+    print("%-10s %-20s %10s %10s %10s %10s" % ("suite", "phase", "wall s", "http", "irods", "peak KiB"))
+    for p in phases:
+        line = "%-10s %-20s %10.4f %10d %10d %10d" % (
+            p['suite'], p['phase'], p['wall_s'], sum(p['http'].values()),
+            sum(p['irods'].values()), p['peak_kib'])
+        old = before.get((p['suite'], p['phase']))
+        if old is not None and old['wall_s'] > 0:
+            line += "   %+.1f%% wall" % ((p['wall_s'] / old['wall_s'] - 1) * 100)
+        print(line)
+        if 'rss_kib' in p:
+            print("%-10s   %-40s %8d" % ("", "child max RSS KiB", p['rss_kib']))
+        for kind in ('http', 'irods'):
+            for route, n in sorted(p[kind].items()):
+                print("%-10s   %-40s %8d" % ("", route, n))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the Verssa automation scripts")
+    parser.add_argument("--incoming", type=int, default=100, help="files waiting in /incoming")
+    parser.add_argument("--running", type=int, default=100, help="analyses already in flight")
+    parser.add_argument("--fits", type=int, default=100, help="FITS files to validate")
+    parser.add_argument("--validated-ratio", type=float, default=0.0,
+                        help="share of FITS files that are already validated")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0,
+                        help="share of FITS files that are copies of an earlier one")
+    parser.add_argument("--corrupt-ratio", type=float, default=0.0,
+                        help="share of FITS files whose bytes no longer match the catalog checksum")
+    parser.add_argument("--integrity", action="store_true",
+                        help="validate with the streaming CHECKSUM/DATASUM and catalog checksum pass")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="validate without the content-keyed verdict cache")
+    parser.add_argument("--submit-rate", type=float, default=1000.0,
+                        help="submission rate limit in requests per second")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="batch this many incoming files of a type into one analysis")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="share of Terrain /analyses requests the stub answers with 503")
+    parser.add_argument("--irods-latency", type=float, default=0.0,
+                        help="seconds added to every iRODS call of the in-memory stand-in")
+    parser.add_argument("--move-denied-ratio", type=float, default=0.0,
+                        help="share of running jobs whose input can't be moved for lack of permission")
+    parser.add_argument("--metrics", metavar="DIR",
+                        help="run with metrics on and write their textfile and summary to DIR")
+    parser.add_argument("--suite", choices=["all", "automate", "validation", "headers"], default="all")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc peak tracking")
+    parser.add_argument("--json", help="write the phase results to this file")
+    parser.add_argument("--compare", help="show wall time change against an earlier --json file")
+    args = parser.parse_args()
+    for option in ('json', 'compare', 'metrics'):
+        if getattr(args, option):
+            setattr(args, option, os.path.abspath(getattr(args, option)))
+
+    terrain = StubTerrain(error_rate=args.error_rate, seed=args.seed).start()
+    store = FakeStore(latency=args.irods_latency)
+    recorder = Recorder(terrain, store, track_memory=not args.no_memory)
+
+    if args.metrics:
+        import metrics
+        metrics.enable('bench')
+
+    workdir = tempfile.mkdtemp(prefix="verssa-bench-")
+    os.chdir(workdir)
+    if recorder.track_memory:
+        tracemalloc.start()
+    try:
+        if args.suite in ("all", "automate"):
+            bench_automate(args, terrain, store, recorder)
+        if args.suite in ("all", "validation"):
+            bench_validation(args, terrain, store, recorder)
+        if args.suite in ("all", "headers"):
+            bench_headers(args, terrain, store, recorder)
+    finally:
+        terrain.stop()
+
+    if args.metrics:
+        metrics.write(args.metrics)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['phases']
+    print_report(recorder.phases, previous)
+
+    if args.json:
+        summary = {'args': vars(args), 'workdir': workdir, 'phases': recorder.phases}
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import json
+import random
+import re
+import threading
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+# each status read moves a job one step along this path
+NEXT_STATUS = {'Submitted': 'Running', 'Running': 'Completed'}
+
+
+class StubTerrain(object):
+    '''
+    Local stand-in for the Terrain routes automate.py uses: /token, /apps,
+    /apps/{system}/{id}, /analyses (listing and submit) and
+    /analyses/{id}/history. Every request is counted by route.
+    '''
+
+    def __init__(self, fail_ratio=0.1, error_rate=0.0, seed=0):
+        self.fail_ratio = fail_ratio
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.jobs = {}
+        self.submissions = []
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        stub = self
+
+        class Handler(StubHandler):
+            terrain = stub
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/terrain" % self.server.server_address[1]
+
+    def add_job(self, status='Submitted'):
+        analysis_id = str(uuid.UUID(int=self.random.getrandbits(128)))
+        self.jobs[analysis_id] = status
+        return analysis_id
+
+    def read_status(self, analysis_id):
+        '''
+        Moves a job one step along and returns its new status, so every
+        poll sees progress
+        '''
+
+        with self.lock:
+            status = self.jobs.get(analysis_id)
+            if status in NEXT_STATUS:
+                status = NEXT_STATUS[status]
+                if status == 'Completed' and self.random.random() < self.fail_ratio:
+                    status = 'Failed'
+                self.jobs[analysis_id] = status
+            return status
+
+    def count(self, route):
+        with self.lock:
+            self.requests[route] += 1
+
+    def reset_counts(self):
+        with self.lock:
+            counts = dict(self.requests)
+            self.requests.clear()
+        return counts
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    terrain = None
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, code=200):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def injected_error(self):
+        if self.terrain.error_rate and self.terrain.random.random() < self.terrain.error_rate:
+            self.send_json({"error": "stub overloaded"}, code=503)
+            return True
+        return False
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        path = parsed.path[len("/terrain"):]
+        params = parse_qs(parsed.query)
+        terrain = self.terrain
+
+        if path == "/token":
+            terrain.count("GET /token")
+            return self.send_json({"access_token": "bench-token", "expires_in": 28800})
+
+        if path == "/apps":
+            terrain.count("GET /apps")
+            search = params.get("search", [""])[0]
+            app_id = "app-" + re.sub(r"\W+", "-", search).strip("-").lower()
+            return self.send_json({"apps": [{"id": app_id, "system_id": "de", "name": search}]})
+
+        match = re.match(r"^/apps/([^/]+)/([^/]+)$", path)
+        if match:
+            terrain.count("GET /apps/{system}/{id}")
+            return self.send_json({"groups": [{"parameters": [{"id": "param-" + match.group(2)}]}]})
+
+        if path == "/analyses":
+            terrain.count("GET /analyses")
+            if self.injected_error():
+                return
+            filters = json.loads(params.get("filter", ["[]"])[0])
+            ids = [f["value"] for f in filters if f.get("field") == "id"]
+            analyses = [{"id": i, "status": terrain.read_status(i)} for i in ids if i in terrain.jobs]
+            return self.send_json({"analyses": analyses})
+
+        match = re.match(r"^/analyses/([^/]+)/history$", path)
+        if match:
+            terrain.count("GET /analyses/{id}/history")
+            if self.injected_error():
+                return
+            status = terrain.read_status(match.group(1))
+            if status is None:
+                return self.send_json({"error": "not found"}, code=404)
+            return self.send_json({"steps": [{"status": status}]})
+
+        self.send_json({"error": "no such route"}, code=404)
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        path = parsed.path[len("/terrain"):]
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+
+        if path == "/analyses":
+            self.terrain.count("POST /analyses")
+            if self.injected_error():
+                return
+            with self.terrain.lock:
+                self.terrain.submissions.append(body)
+            analysis_id = self.terrain.add_job('Submitted')
+            return self.send_json({"id": analysis_id, "status": "Submitted"})
+
+        self.send_json({"error": "no such route"}, code=404)
@@ -0,0 +1,114 @@
+import base64
+import hashlib
+import random
+
+BLOCK_SIZE = 2880
+
+VALID_HEADER = [
+    ("SIMPLE", True),
+    ("BITPIX", 16),
+    ("NAXIS", 2),
+    ("NAXIS1", 64),
+    ("NAXIS2", 64),
+    ("DATE-OBS", "2019-05-05T03:25:53.30"),
+    ("EXPTIME", 1.5),
+    ("OBJCTRA", "12 34 56"),
+    ("OBJCTDEC", "-12 34 56"),
+    ("SITELAT", "32 13 57"),
+    ("SITELONG", "-110 56 55"),
+    ("SITEELEV", "728.0"),
+    ("TELESCOP", "BENCH-SCOPE"),
+    ("COUNTRY", "USA"),
+]
+
+INCOMING_TYPES = ["qmg", "bmg2", "pmg2", "fdata"]
+
+
+def card(key, value):
+    if isinstance(value, bool):
+        text = "%20s" % ("T" if value else "F")
+    elif isinstance(value, (int, float)):
+        text = "%20s" % repr(value)
+    else:
+        text = "'%-8s'" % value.replace("'", "''")
+    return ("%-8s= %s" % (key, text)).ljust(80)[:80].encode("ascii")
+
+
+def pad(data, fill=b" "):
+    remainder = len(data) % BLOCK_SIZE
+    if remainder:
+        data += fill * (BLOCK_SIZE - remainder)
+    return data
+
+
+def fits_bytes(header=VALID_HEADER, extra_cards=0):
+    '''
+    A small but well formed FITS file: primary header plus a 64x64 16-bit
+    data unit
+    '''
+
+    cards = [card(key, value) for key, value in header]
+    cards += [card("FILL%04d" % i, "filler") for i in range(extra_cards)]
+    head = pad(b"".join(cards) + b"END".ljust(80))
+    naxis = dict(header)
+    data_len = abs(naxis.get("BITPIX", 16)) // 8 * naxis.get("NAXIS1", 0) * naxis.get("NAXIS2", 0)
+    return head + pad(b"\0" * data_len, b"\0")
+
+
+def broken_header(rng):
+    '''
+    A header with one or two keywords missing or malformed
+    '''
+
+    header = list(VALID_HEADER)
+    for _ in range(rng.randint(1, 2)):
+        i = rng.randrange(5, len(header))
+        key, value = header[i]
+        if rng.random() < 0.5:
+            del header[i]
+        else:
+            header[i] = (key, "bad")
+    return header
+
+
+def irods_checksum(data):
+    return "sha2:" + base64.b64encode(hashlib.sha256(data).digest()).decode("ascii")
+
+
+def populate_validation(store, root, count, subcollections=4, invalid_ratio=0.1,
+                        validated_ratio=0.0, duplicate_ratio=0.0, corrupt_ratio=0.0, seed=0):
+    '''
+    Fills store with count FITS objects spread over subcollections of root;
+    some are broken, some already carry a 'validated' AVU and some are
+    byte-for-byte copies of an earlier frame. Corrupt ones have a flipped
+    data byte that only the catalog checksum catches.
+    '''
+
+    rng = random.Random(seed)
+    made = []
+    for i in range(count):
+        path = "%s/night%02d/frame%06d.fits" % (root, i % subcollections, i)
+        if len(made) > 0 and rng.random() < duplicate_ratio:
+            content = rng.choice(made)
+        elif rng.random() < invalid_ratio:
+            content = fits_bytes(broken_header(rng) + [("FRAMENO", i)])
+        else:
+            content = fits_bytes(VALID_HEADER + [("FRAMENO", i)])
+        made.append(content)
+        checksum = irods_checksum(content)
+        if rng.random() < corrupt_ratio:
+            damaged = bytearray(content)
+            damaged[-1] ^= 0xFF
+            content = bytes(damaged)
+        obj = store.add(path, content, checksum)
+        if rng.random() < validated_ratio:
+            obj.metadata.avus.append(('validated', 'true'))
+    # the failed folder exists in the real tree, keep one file in it
+    store.add(root + "/validation_failed/placeholder.err", b"")
+
+
+def populate_incoming(store, incoming_dir, count, seed=0):
+    rng = random.Random(seed)
+    for i in range(count):
+        ftype = rng.choice(INCOMING_TYPES)
+        store.add("%s/track%06d.%s" % (incoming_dir, i, ftype), b"x" * 64)
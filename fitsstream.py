@@ -0,0 +1,201 @@
+import re
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+END_CARD = b"END" + b" " * (CARD_SIZE - 3)
+
+# a primary header larger than this is not something we want to validate
+MAX_HEADER_BLOCKS = 1000
+
+
+class HeaderError(Exception):
+    pass
+
+
+def read_block(f, size=BLOCK_SIZE):
+    '''
+    Reads exactly size bytes unless the stream ends first; iRODS streams
+    can hand back short reads
+    '''
+
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = f.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def read_header_bytes(f, max_blocks=MAX_HEADER_BLOCKS):
+    '''
+    Reads blocks from f up to and including the one holding the END card
+    and returns them as one bytes buffer
+    '''
+
+    blocks = []
+    for _ in range(max_blocks):
+        block = read_block(f)
+        if len(block) < BLOCK_SIZE:
+            raise HeaderError("file ended before the END card of the primary header")
+        blocks.append(block)
+        for i in range(0, BLOCK_SIZE, CARD_SIZE):
+            if block[i:i + CARD_SIZE] == END_CARD:
+                return b"".join(blocks)
+    raise HeaderError("no END card in the first %d blocks" % max_blocks)
+
+
+INT_RE = re.compile(r"[+-]?\d+$")
+FLOAT_RE = re.compile(r"[+-]?(\d+\.?\d*|\.\d+)([EeDd][+-]?\d+)?$")
+COMPLEX_RE = re.compile(r"\(\s*([^,]+?)\s*,\s*([^)]+?)\s*\)$")
+
+
+class Header(object):
+    '''
+    Keyword values of one header, typed the way astropy types them: bool
+    for T/F, int, float, complex, str (trailing blanks dropped) and None
+    for an empty value. A repeated keyword keeps its first value.
+    Commentary cards (COMMENT, HISTORY, blank) are not kept.
+    '''
+
+    def __init__(self, values):
+        self.values = values
+
+    def __contains__(self, key):
+        return key.upper() in self.values
+
+    def __getitem__(self, key):
+        return self.values[key.upper()]
+
+    def get(self, key, default=None):
+        return self.values.get(key.upper(), default)
+
+    def keys(self):
+        return list(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return "<Header %d keywords>" % len(self.values)
+
+
+def parse_string(text):
+    '''
+    Reads a quoted value from the start of text ('' is an escaped quote).
+    Returns the string and whatever follows the closing quote.
+    '''
+
+    chars = []
+    i = 1
+    while i < len(text):
+        if text[i] == "'":
+            if text[i + 1:i + 2] == "'":
+                chars.append("'")
+                i += 2
+                continue
+            return "".join(chars), text[i + 1:]
+        chars.append(text[i])
+        i += 1
+    # the card's text is left out: messages end up in the failure email
+    raise HeaderError("unterminated string")
+
+
+def parse_number(text):
+    if INT_RE.match(text):
+        return int(text)
+    if FLOAT_RE.match(text):
+        return float(text.replace("D", "E").replace("d", "e"))
+    return None
+
+
+def parse_value(text):
+    '''
+    The typed value of the field after "= "; quoted strings are handled by
+    the caller
+    '''
+
+    text = text.split("/", 1)[0].strip()
+    if text == "":
+        return None
+    if text == "T":
+        return True
+    if text == "F":
+        return False
+    number = parse_number(text)
+    if number is not None:
+        return number
+    match = COMPLEX_RE.match(text)
+    if match:
+        real, imag = parse_number(match.group(1)), parse_number(match.group(2))
+        if real is not None and imag is not None:
+            return complex(real, imag)
+    # not valid FITS; keep the text so a rule can report it
+    return text
+
+
+def card_string(field, index):
+    '''
+    The string value of the card at index, as parse_string reads it
+    '''
+
+    try:
+        return parse_string(field)[0].rstrip()
+    except HeaderError as e:
+        raise HeaderError("%s in card %d" % (e, index + 1))
+
+
+def parse_header(buf):
+    '''
+    Turns a raw header buffer (whole 80 byte cards, up to the END card) into
+    a Header supporting "key in hdr", hdr[key] and hdr.get(key). Long
+    strings split over CONTINUE cards are joined.
+    '''
+
+    text = buf.decode("ascii", "replace")
+    values = {}
+    continuing = None  # keyword of a string value ending in &
+    for i in range(0, len(text) - CARD_SIZE + 1, CARD_SIZE):
+        card = text[i:i + CARD_SIZE]
+        keyword = card[:8].strip().upper()
+        if keyword == "END":
+            break
+
+        if keyword == "CONTINUE":
+            field = card[8:].lstrip()
+            if continuing is None or not field.startswith("'"):
+                continue
+            part = card_string(field, i // CARD_SIZE)
+            value = values[continuing][:-1] + part
+            values[continuing] = value
+            continuing = continuing if value.endswith("&") else None
+            continue
+        continuing = None
+
+        if keyword == "HIERARCH" and "=" in card:
+            keyword, field = card[9:].split("=", 1)
+            keyword = keyword.strip().upper()
+        elif card[8:10] == "= ":
+            field = card[10:]
+        else:
+            continue  # commentary card
+
+        stripped = field.lstrip()
+        if stripped.startswith("'"):
+            value = card_string(stripped, i // CARD_SIZE)
+            if value.endswith("&"):
+                continuing = keyword
+        else:
+            value = parse_value(field)
+
+        if keyword not in values:
+            values[keyword] = value
+        elif continuing == keyword:
+            continuing = None
+    return Header(values)
+
+
+def read_primary_header(f):
+    return parse_header(read_header_bytes(f))
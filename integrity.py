@@ -0,0 +1,220 @@
+import base64
+import hashlib
+import sys
+import threading
+from array import array
+
+import fitsstream
+
+
+# data units are read this many blocks at a time (about 4 MiB) into a
+# buffer each thread keeps for all its files
+CHUNK_BLOCKS = 1456
+CHUNK_SIZE = fitsstream.BLOCK_SIZE * CHUNK_BLOCKS
+
+# the ones' complement sum of an HDU whose CHECKSUM is right
+NEGATIVE_ZERO = 0xFFFFFFFF
+
+# iRODS checksum prefix -> hash; md5 checksums have no prefix
+DIGESTS = {
+    'sha2': (hashlib.sha256, True),
+    'sha512': (hashlib.sha512, True),
+    'sha1': (hashlib.sha1, True),
+    None: (hashlib.md5, False),
+}
+
+WORD_TYPE = 'I' if array('I').itemsize == 4 else 'L'
+
+_buffers = threading.local()
+# numpy module, False when it isn't installed, None until first needed;
+# imported late so a run with nothing to check doesn't pay for it
+numpy = None
+
+
+def chunk_buffer():
+    if getattr(_buffers, 'buf', None) is None:
+        _buffers.buf = bytearray(CHUNK_SIZE)
+    return _buffers.buf
+
+
+def word_sum(buf):
+    '''
+    Plain sum of buf as big-endian 32-bit words; fold() turns it into the
+    ones' complement sum
+    '''
+
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:  # astropy brings numpy, but the plain sum works without it
+            numpy = False
+    if numpy:
+        return int(numpy.frombuffer(buf, dtype='>u4').sum(dtype=numpy.uint64))
+    words = array(WORD_TYPE)
+    words.frombytes(buf)
+    if sys.byteorder == 'little':
+        words.byteswap()
+    return sum(words)
+
+
+def fold(total):
+    while total >> 32:
+        total = (total & 0xFFFFFFFF) + (total >> 32)
+    return total
+
+
+def data_size(hdr, primary):
+    '''
+    Bytes in the data unit following hdr, before padding
+    '''
+
+    naxis = hdr.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+    axes = [hdr.get('NAXIS%d' % i, 0) for i in range(1, naxis + 1)]
+    if primary and hdr.get('GROUPS') and axes[0] == 0:
+        axes = axes[1:]  # random groups
+    count = 1
+    for n in axes:
+        count *= n
+    return abs(hdr.get('BITPIX', 8)) // 8 * hdr.get('GCOUNT', 1) * (hdr.get('PCOUNT', 0) + count)
+
+
+def padded(size):
+    return -(-size // fitsstream.BLOCK_SIZE) * fitsstream.BLOCK_SIZE
+
+
+class HashingReader(object):
+    '''
+    Wraps an open data object so every byte read also goes through the
+    iRODS checksum's hash (when there is one to compare against)
+    '''
+
+    def __init__(self, f, catalog_checksum):
+        self.f = f
+        self.position = 0
+        self.digest = None
+        self.prefix = None
+        if catalog_checksum:
+            prefix, sep, _ = catalog_checksum.partition(":")
+            self.prefix = prefix if sep else None
+            if self.prefix in DIGESTS:
+                self.digest = DIGESTS[self.prefix][0]()
+
+    def read(self, size):
+        data = self.f.read(size)
+        self.position += len(data)
+        if self.digest is not None:
+            self.digest.update(data)
+        return data
+
+    def readfull(self, view):
+        '''
+        Fills view unless the stream ends first; returns the bytes read
+        '''
+
+        got = 0
+        while got < len(view):
+            if hasattr(self.f, 'readinto'):
+                n = self.f.readinto(view[got:])
+            else:
+                data = self.f.read(len(view) - got)
+                n = len(data)
+                view[got:got + n] = data
+            if not n:
+                break
+            got += n
+        if self.digest is not None:
+            self.digest.update(view[:got])
+        self.position += got
+        return got
+
+    def hexdigest(self):
+        if DIGESTS[self.prefix][1]:
+            return self.prefix + ":" + base64.b64encode(self.digest.digest()).decode("ascii")
+        return self.digest.hexdigest()
+
+
+def sum_data(reader, length, interrupt=None):
+    '''
+    Streams length bytes through the thread's chunk buffer. Returns the
+    unfolded word sum and the number of bytes actually there.
+    '''
+
+    view = memoryview(chunk_buffer())
+    total = 0
+    remaining = length
+    while remaining > 0:
+        if interrupt is not None:
+            interrupt()
+        want = min(remaining, CHUNK_SIZE)
+        got = reader.readfull(view[:want])
+        total += word_sum(view[:got - got % 4])
+        remaining -= got
+        if got < want:
+            break
+    return total, length - remaining
+
+
+def verify(f, catalog_checksum=None, interrupt=None):
+    '''
+    Reads a whole FITS file once, checking the CHECKSUM and DATASUM of every
+    HDU that has them, that no data unit is cut short and, if
+    catalog_checksum is given, that the bytes match the iRODS checksum.
+    interrupt is called before each chunk and may raise to give up.
+
+    Returns the primary header and a list of problems (empty if the file is
+    intact). A primary header that can't be read raises
+    fitsstream.HeaderError, as fitsstream.read_primary_header does.
+    '''
+
+    reader = HashingReader(f, catalog_checksum)
+    problems = []
+    primary = None
+    hdu = 0
+    while True:
+        start = reader.position
+        try:
+            raw = fitsstream.read_header_bytes(reader)
+        except fitsstream.HeaderError as e:
+            if hdu == 0:
+                raise
+            if reader.position > start:
+                problems.append("ERROR: HDU %d header unreadable: %s" % (hdu, e))
+            break
+        hdr = fitsstream.parse_header(raw)
+        if hdu == 0:
+            primary = hdr
+
+        length = padded(data_size(hdr, hdu == 0))
+        data_total, got = sum_data(reader, length, interrupt)
+        if got < length:
+            problems.append("ERROR: truncated, HDU %d has %d of %d data bytes" % (hdu, got, length))
+            break
+
+        data_sum = fold(data_total)
+        if 'DATASUM' in hdr:
+            try:
+                expected = int(str(hdr['DATASUM']).strip())
+            except ValueError:
+                expected = None
+            if expected is None or (expected % NEGATIVE_ZERO) != (data_sum % NEGATIVE_ZERO):
+                # the header's own text stays out of the message, which ends up in an email
+                problems.append("ERROR: HDU %d DATASUM does not match the data, which sums to %d"
+                                % (hdu, data_sum))
+        if 'CHECKSUM' in hdr and fold(word_sum(raw) + data_total) != NEGATIVE_ZERO:
+            problems.append("ERROR: HDU %d CHECKSUM does not verify" % hdu)
+        hdu += 1
+
+    if reader.digest is not None:
+        # bytes after the last HDU still count towards the catalog checksum
+        view = memoryview(chunk_buffer())
+        while reader.readfull(view) > 0:
+            if interrupt is not None:
+                interrupt()
+        computed = reader.hexdigest()
+        if computed != catalog_checksum:
+            problems.append("ERROR: iRODS checksum mismatch, catalog has %s but the data is %s"
+                            % (catalog_checksum, computed))
+    return primary, problems
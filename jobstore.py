@@ -0,0 +1,261 @@
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+from logzero import logger
+
+import storage
+
+
+STORE_FILE = "jobs.sqlite"
+LEGACY_FILE = "db.json"
+
+# column name -> SQLite declaration, adapted for PostgreSQL by
+# storage.column_type; entries handed out by the store always carry every
+# column so callers can rely on the keys being there
+COLUMNS = [
+    ('name', 'TEXT PRIMARY KEY'),
+    ('id', 'TEXT'),
+    ('status', 'TEXT'),
+    ('submitted_at', 'REAL'),
+    ('next_poll_at', 'REAL'),
+    ('last_polled_at', 'REAL'),
+    ('poll_errors', 'INTEGER DEFAULT 0'),
+    # batched file types: 'Pending' rows wait here with their request until
+    # the batch is submitted; every member of a batch shares its analysis id
+    ('ftype', 'TEXT'),
+    ('request', 'TEXT'),
+    ('batch', 'TEXT'),
+    # a finished job whose input could not be moved for lack of permission
+    # is left alone until then
+    ('move_after', 'REAL'),
+]
+
+INDEXES = [
+    ('jobs_status', 'status'),
+    ('jobs_id', 'id'),
+    ('jobs_next_poll', 'status, next_poll_at'),
+]
+
+
+class JobStore(ABC):
+    '''
+    Interface for the job state kept between runs. Each entry is a dict
+    keyed by the iRODS path of the input file ('name') with the Terrain
+    analysis 'id' and its last known 'status'.
+    '''
+
+    def insert(self, entry):
+        self.insert_many([entry])
+
+    @abstractmethod
+    def insert_many(self, entries):
+        '''
+        Adds entries, replacing any with the same name
+        '''
+
+    @abstractmethod
+    def get(self, name):
+        '''
+        The entry for name, or None
+        '''
+
+    @abstractmethod
+    def names(self):
+        '''
+        Set of every path the store knows about, for bulk "already
+        submitted" checks
+        '''
+
+    @abstractmethod
+    def search_status(self, *statuses):
+        '''
+        Every entry in one of statuses
+        '''
+
+    @abstractmethod
+    def by_ids(self, ids):
+        '''
+        Every entry belonging to one of the analysis ids
+        '''
+
+    @abstractmethod
+    def due(self, statuses, now, limit):
+        '''
+        Up to limit entries in one of statuses whose next_poll_at has passed
+        (or was never set), the longest overdue first
+        '''
+
+    @abstractmethod
+    def write_back(self, entries):
+        '''
+        Saves changed entries (matched on name) in one transaction. Only the
+        keys present in each entry are written.
+        '''
+
+    @abstractmethod
+    def remove(self, names):
+        '''
+        Drops the entries for names
+        '''
+
+    @abstractmethod
+    def batch(self):
+        '''
+        Context manager grouping every write made inside the block into one
+        transaction; blocks may nest
+        '''
+
+    @abstractmethod
+    def close(self):
+        pass
+
+
+class SQLJobStore(JobStore):
+    '''
+    Job store in a SQL table with indexes on name, status and id, so lookups
+    don't scan and writes don't rewrite the whole store. target is a SQLite
+    file (WAL mode, workers on one host) or a postgresql:// URL (workers on
+    any number of hosts).
+    '''
+
+    def __init__(self, target=STORE_FILE):
+        self.target = target
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.conn = storage.connect(target)
+        self._create_schema()
+
+    def _create_schema(self):
+        with self.batch():
+            self.conn.execute("CREATE TABLE IF NOT EXISTS jobs (name TEXT PRIMARY KEY)")
+            existing = storage.column_names(self.conn, "jobs")
+            for column, decl in COLUMNS:
+                if column not in existing:
+                    self.conn.execute("ALTER TABLE jobs ADD COLUMN %s %s"
+                                      % (column, storage.column_type(self.conn, decl)))
+            for index, column in INDEXES:
+                self.conn.execute("CREATE INDEX IF NOT EXISTS %s ON jobs (%s)" % (index, column))
+
+    @contextmanager
+    def batch(self):
+        with self.lock:
+            if self.depth == 0:
+                storage.begin(self.conn)
+            self.depth += 1
+            try:
+                yield self
+            except BaseException:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.conn.execute("ROLLBACK")
+                raise
+            self.depth -= 1
+            if self.depth == 0:
+                self.conn.execute("COMMIT")
+
+    def _rows(self, sql, params=()):
+        with self.lock:
+            return storage.dict_rows(self.conn.execute(sql, params))
+
+    def insert_many(self, entries):
+        columns = [c for c, _ in COLUMNS]
+        sql = "INSERT INTO jobs (%s) VALUES (%s) ON CONFLICT (name) DO UPDATE SET %s" % (
+            ", ".join(columns), ", ".join("?" for _ in columns),
+            ", ".join("%s = excluded.%s" % (c, c) for c in columns if c != 'name'))
+        with self.batch():
+            self.conn.executemany(sql, [tuple(e.get(c) for c in columns)
+                                        for e in map(with_defaults, entries)])
+
+    def get(self, name):
+        rows = self._rows("SELECT * FROM jobs WHERE name = ?", (name,))
+        return rows[0] if len(rows) > 0 else None
+
+    def names(self):
+        with self.lock:
+            return set(row[0] for row in self.conn.execute("SELECT name FROM jobs"))
+
+    def search_status(self, *statuses):
+        return self._rows("SELECT * FROM jobs WHERE status IN (%s)"
+                          % ", ".join("?" for _ in statuses), statuses)
+
+    def by_ids(self, ids):
+        ids = list(set(ids))
+        rows = []
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows.extend(self._rows("SELECT * FROM jobs WHERE id IN (%s)"
+                                   % ", ".join("?" for _ in chunk), chunk))
+        return rows
+
+    def due(self, statuses, now, limit):
+        return self._rows("SELECT * FROM jobs WHERE status IN (%s)"
+                          " AND (next_poll_at IS NULL OR next_poll_at <= ?)"
+                          " ORDER BY next_poll_at IS NOT NULL, next_poll_at LIMIT ?"
+                          % ", ".join("?" for _ in statuses),
+                          tuple(statuses) + (now, limit))
+
+    def write_back(self, entries):
+        known = set(c for c, _ in COLUMNS if c != 'name')
+        by_columns = {}
+        for e in entries:
+            columns = tuple(sorted(c for c in e if c in known))
+            by_columns.setdefault(columns, []).append(tuple(e[c] for c in columns) + (e['name'],))
+        with self.batch():
+            for columns, rows in by_columns.items():
+                if len(columns) == 0:
+                    continue
+                sql = "UPDATE jobs SET %s WHERE name = ?" % ", ".join(c + " = ?" for c in columns)
+                self.conn.executemany(sql, rows)
+
+    def remove(self, names):
+        with self.batch():
+            self.conn.executemany("DELETE FROM jobs WHERE name = ?", [(n,) for n in names])
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def with_defaults(entry):
+    '''
+    Copy of a new entry with the bookkeeping fields filled in
+    '''
+
+    entry = dict(entry)
+    entry.setdefault('submitted_at', time.time())
+    entry.setdefault('poll_errors', 0)
+    return entry
+
+
+def migrate_legacy(store, legacy_path=LEGACY_FILE):
+    '''
+    One-time import of an existing TinyDB db.json into the store. The old
+    file is renamed afterwards so the import never runs twice.
+    '''
+
+    if not os.path.exists(legacy_path):
+        return 0
+    with open(legacy_path) as f:
+        content = f.read().strip()
+    tables = json.loads(content) if content else {}
+    entries = list(tables.get('_default', {}).values())
+    if len(entries) > 0:
+        store.insert_many(entries)
+    os.replace(legacy_path, legacy_path + ".migrated")
+    logger.info("migrated %d entries from %s" % (len(entries), legacy_path))
+    return len(entries)
+
+
+def open_store(target=STORE_FILE, legacy_path=LEGACY_FILE):
+    '''
+    Opens the job store in a SQLite file or PostgreSQL database, importing
+    db.json on first use
+    '''
+
+    store = SQLJobStore(target)
+    migrate_legacy(store, legacy_path)
+    return store
@@ -0,0 +1,118 @@
+import os
+import socket
+import threading
+import time
+
+from logzero import logger
+
+import storage
+
+
+# a claim lapses this long after it was taken, so work held by a worker
+# that died is handed out again
+LEASE_TTL = 15 * 60
+# lapsed leases are deleted once they are this old
+PURGE_AFTER = 60 * 60
+
+
+def worker_owner(name=None, pid=True):
+    '''
+    Owner string for this process, readable in the lease table. With pid it
+    is unique per process; without, a worker run again under the same name
+    gets back the leases its previous run still held.
+    '''
+
+    host = socket.gethostname()
+    if not pid:
+        return "%s@%s" % (name or host, host)
+    return "%s@%s:%d" % (name or host, host, os.getpid())
+
+
+def owner_host(owner):
+    return owner.split("@", 1)[-1].split(":", 1)[0]
+
+
+class Leases(object):
+    '''
+    Expiring claims on work items, shared by every worker through one
+    table. A key can only be held by one owner at a time; taking a key and
+    the expiry check are a single upsert, so two workers never both get the
+    same item.
+
+    target is a SQLite file or a postgresql:// URL. The SQLite file is in
+    WAL mode, which relies on shared memory, so its workers have to run on
+    the same host; opening it while another host holds live leases raises
+    RuntimeError. Workers on several hosts share a PostgreSQL database.
+    '''
+
+    def __init__(self, target, owner, ttl=LEASE_TTL):
+        self.target = target
+        self.owner = owner
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = storage.connect(target)
+        self.shared = storage.is_postgres(self.conn)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT, %s)"
+                          % storage.column_type(self.conn, "expires_at REAL"))
+        if not self.shared:
+            self._check_host()
+
+    def _check_host(self):
+        host = owner_host(self.owner)
+        for (owner,) in self.conn.execute("SELECT DISTINCT owner FROM leases WHERE expires_at >= ?",
+                                          (time.time(),)):
+            if owner_host(owner) != host:
+                self.conn.close()
+                raise RuntimeError("%s has live leases held on %s; workers sharing a lease file "
+                                   "must all run on one host, use a PostgreSQL database_url to "
+                                   "spread them over several" % (self.target, owner_host(owner)))
+
+    def claim(self, keys, limit=None, now=None):
+        '''
+        Takes every key that is free, lapsed or already ours, up to limit
+        of them, and returns those in the order given
+        '''
+
+        now = time.time() if now is None else now
+        claimed = []
+        with self.lock:
+            # in PostgreSQL each upsert commits on its own: one transaction
+            # over many keys could deadlock with a worker taking them in
+            # another order. SQLite has one writer anyway and saves the
+            # per-commit sync this way.
+            if not self.shared:
+                storage.begin(self.conn)
+            try:
+                for key in keys:
+                    if limit is not None and len(claimed) >= limit:
+                        break
+                    cur = self.conn.execute(
+                        "INSERT INTO leases (key, owner, expires_at) VALUES (?, ?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, "
+                        "expires_at = excluded.expires_at "
+                        "WHERE leases.expires_at < ? OR leases.owner = ?",
+                        (key, self.owner, now + self.ttl, now, self.owner))
+                    if cur.rowcount == 1:
+                        claimed.append(key)
+                self.conn.execute("DELETE FROM leases WHERE expires_at < ?", (now - PURGE_AFTER,))
+            except BaseException:
+                if not self.shared:
+                    self.conn.execute("ROLLBACK")
+                raise
+            if not self.shared:
+                self.conn.execute("COMMIT")
+        if len(claimed) < len(keys):
+            logger.debug("claimed %d of %d items" % (len(claimed), len(keys)))
+        return claimed
+
+    def release(self, keys):
+        '''
+        Gives up our claims on keys so other workers can take them at once
+        '''
+
+        with self.lock:
+            self.conn.executemany("DELETE FROM leases WHERE key = ? AND owner = ?",
+                                  [(key, self.owner) for key in keys])
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,314 @@
+import argparse
+import gzip
+import hashlib
+import math
+import os
+import struct
+import time
+
+from logzero import logger
+
+
+LEDGER_DIR = "ledger"
+# one segment per UTC day; finished days are gzipped and the oldest dropped
+SEGMENT_FORMAT = "events-%Y%m%d.bin"
+RETAIN_DAYS = 400
+
+# lifecycle events, in the order a job normally goes through them. The code
+# is what is stored, so new events go at the end.
+EVENTS = ['arrived', 'seen', 'submitted', 'running', 'completed', 'failed', 'canceled', 'moved']
+CODES = dict((event, code) for code, event in enumerate(EVENTS))
+FINISHED = ('completed', 'failed', 'canceled')
+
+# time, job key (first 8 bytes of the sha1 of its iRODS path), event code,
+# length of the app name that follows: 18 bytes plus the extension
+RECORD = struct.Struct('<dQBB')
+
+# durations reported per app: name -> (from event, to event)
+SPANS = [
+    ('detect', 'arrived', 'seen'),
+    ('to_submit', 'arrived', 'submitted'),
+    ('queue', 'submitted', 'running'),
+    ('run', 'running', 'finished'),
+    ('turnaround', 'arrived', 'finished'),
+]
+QUANTILES = (0.5, 0.9, 0.99)
+# histogram buckets grow by this factor, so a percentile is within about 4%
+BUCKET_GROWTH = 2 ** (1 / 8.0)
+# jobs with no event for this long are dropped from a report's working set
+STALE_AFTER = 30 * 24 * 60 * 60
+
+# everything below is a no-op until enable() is called
+enabled = False
+directory = None
+_fd = None
+_segment = None
+
+
+def job_key(name):
+    return struct.unpack('<Q', hashlib.sha1(name.encode("utf-8")).digest()[:8])[0]
+
+
+def app_of(name):
+    return name.split(".")[-1]
+
+
+def segment_name(when):
+    return time.strftime(SEGMENT_FORMAT, time.gmtime(when))
+
+
+def enable(path=LEDGER_DIR):
+    '''
+    Starts recording into the segments in path
+    '''
+
+    global enabled, directory
+    try:
+        os.makedirs(path, exist_ok=True)
+    except (IOError, OSError) as e:
+        logger.error("could not open the ledger in %s: %s" % (path, e))
+        return
+    enabled = True
+    directory = path
+
+
+def encode(event, name, when):
+    app = app_of(name).encode("utf-8")[:255]
+    return RECORD.pack(when, job_key(name), CODES[event], len(app)) + app
+
+
+def record(event, name, when=None):
+    '''
+    Appends one event for the job whose input is name. Each record goes out
+    in a single write on an O_APPEND descriptor, so several workers can
+    share a segment.
+    '''
+
+    if not enabled:
+        return
+    record_many([(event, name, when)])
+
+
+def record_many(events):
+    '''
+    Appends (event, name, when) triples; a when of None is now. Old
+    segments are compressed and pruned whenever a new one is started, so a
+    long-running daemon rotates too.
+    '''
+
+    global _fd, _segment
+    if not enabled or len(events) == 0:
+        return
+    now = time.time()
+    try:
+        segment = segment_name(now)
+        if segment != _segment:
+            if _fd is not None:
+                os.close(_fd)
+            _fd = os.open(os.path.join(directory, segment), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            _segment = segment
+            rotate(directory, now)
+        for event, name, when in events:
+            os.write(_fd, encode(event, name, now if when is None else when))
+    except (IOError, OSError) as e:
+        logger.error("could not write to the ledger: %s" % e)
+
+
+def rotate(path, now):
+    '''
+    Gzips the segments of days before yesterday (a worker may still be
+    finishing yesterday's) and deletes those older than RETAIN_DAYS
+    '''
+
+    keep_open = (segment_name(now), segment_name(now - 24 * 60 * 60))
+    oldest = segment_name(now - RETAIN_DAYS * 24 * 60 * 60)
+    for filename in os.listdir(path):
+        segment = filename[:-3] if filename.endswith(".gz") else filename
+        if not (segment.startswith("events-") and segment.endswith(".bin")):
+            continue
+        full = os.path.join(path, filename)
+        try:
+            if segment < oldest:
+                os.remove(full)
+                logger.info("dropped ledger segment " + filename)
+            elif not filename.endswith(".gz") and filename not in keep_open:
+                tmp_path = "%s.gz.%d.tmp" % (full, os.getpid())
+                with open(full, "rb") as f, gzip.open(tmp_path, "wb") as out:
+                    out.write(f.read())
+                os.replace(tmp_path, full + ".gz")
+                os.remove(full)
+        except FileNotFoundError:
+            pass  # another worker rotated it first
+
+
+def segments(path, since=None):
+    '''
+    Segment files in path in time order, from the day of since on
+    '''
+
+    first = None if since is None else segment_name(since)
+    names = []
+    for filename in os.listdir(path):
+        segment = filename[:-3] if filename.endswith(".gz") else filename
+        if segment.startswith("events-") and segment.endswith(".bin") and \
+                (first is None or segment >= first):
+            names.append((segment, filename))
+    return [os.path.join(path, filename) for _, filename in sorted(names)]
+
+
+def read_segment(filename):
+    '''
+    Yields (when, key, event, app) for each record; a record cut short by a
+    crash ends the segment
+    '''
+
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rb") as f:
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            when, key, code, length = RECORD.unpack(head)
+            app = f.read(length)
+            if len(app) < length:
+                return
+            if code < len(EVENTS):
+                yield when, key, EVENTS[code], app.decode("utf-8", "replace")
+
+
+def read(path=LEDGER_DIR, since=None):
+    for filename in segments(path, since):
+        for item in read_segment(filename):
+            if since is None or item[0] >= since:
+                yield item
+
+
+class LogHistogram(object):
+    '''
+    Counts per log-spaced bucket: constant memory however many values go in
+    '''
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value):
+        value = max(value, 0.0)
+        i = int(math.floor(math.log(value, BUCKET_GROWTH))) if value >= 1 else 0
+        self.buckets[i] = self.buckets.get(i, 0) + 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        '''
+        Middle of the bucket holding the q-th value, never above the max
+        '''
+
+        rank = q * self.count
+        seen = 0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if seen >= rank:
+                if i == 0:
+                    return min(1.0, self.max)
+                return min(BUCKET_GROWTH ** (i + 0.5), self.max)
+        return self.max
+
+
+def spans(events):
+    '''
+    Streams the durations in SPANS out of a time ordered event stream,
+    yielding (app, span, seconds) as each job reaches the end of a span.
+    Only jobs still in flight are held in memory.
+    '''
+
+    jobs = {}
+    swept = None
+    for when, key, event, app in events:
+        if swept is None or when - swept > 24 * 60 * 60:
+            for stale in [k for k, job in jobs.items() if when - job['last'] > STALE_AFTER]:
+                del jobs[stale]
+            swept = when
+
+        if event in FINISHED:
+            event = 'finished'
+        job = jobs.get(key)
+        if job is None:
+            if event in ('moved', 'finished'):
+                continue  # its earlier events are before the range read
+            job = jobs[key] = {'last': when}
+        job['last'] = when
+        if event in job:
+            continue  # only the first time counts, workers may repeat events
+        job[event] = when
+
+        for span, start, end in SPANS:
+            if end == event and start in job:
+                yield app, span, when - job[start]
+        if event == 'finished':
+            del jobs[key]
+
+
+def report(path=LEDGER_DIR, since=None, app=None):
+    '''
+    {app: {span: LogHistogram}} over the ledger, read in one pass
+    '''
+
+    out = {}
+    for job_app, span, seconds in spans(read(path, since)):
+        if app is not None and job_app != app:
+            continue
+        out.setdefault(job_app, {}).setdefault(span, LogHistogram()).add(seconds)
+    return out
+
+
+def history(name, path=LEDGER_DIR, since=None):
+    '''
+    Every (when, event) recorded for the job whose input is name
+    '''
+
+    key = job_key(name)
+    return [(when, event) for when, k, event, _ in read(path, since) if k == key]
+
+
+def format_seconds(seconds):
+    if seconds < 120:
+        return "%.0fs" % seconds
+    if seconds < 2 * 60 * 60:
+        return "%.1fm" % (seconds / 60)
+    return "%.1fh" % (seconds / 3600)
+
+
+def print_report(histograms):
+    print("%-8s %-11s %8s %8s %8s %8s %8s" % (("app", "span", "count")
+                                             + tuple("p%g" % (q * 100) for q in QUANTILES) + ("max",)))
+    for app in sorted(histograms):
+        for span, _, _ in SPANS:
+            h = histograms[app].get(span)
+            if h is None:
+                continue
+            print("%-8s %-11s %8d %8s %8s %8s %8s" % ((app, span, h.count)
+                  + tuple(format_seconds(h.quantile(q)) for q in QUANTILES)
+                  + (format_seconds(h.max),)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Report on the job lifecycle ledger")
+    parser.add_argument("--dir", default=LEDGER_DIR, help="ledger directory")
+    parser.add_argument("--days", type=float,
+                        help="only read the last DAYS days (default: everything kept)")
+    commands = parser.add_subparsers(dest="command")
+    report_parser = commands.add_parser("report", help="percentiles per app of time to submit, "
+                                                       "time in queue and turnaround")
+    report_parser.add_argument("--app", help="only this file type")
+    history_parser = commands.add_parser("history", help="the events recorded for one file")
+    history_parser.add_argument("path", help="iRODS path of the input file")
+    args = parser.parse_args()
+
+    since = None if args.days is None else time.time() - args.days * 24 * 60 * 60
+    if args.command == "history":
+        for when, event in history(args.path, args.dir, since):
+            print("%s %s" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when)), event))
+    else:
+        print_report(report(args.dir, since, getattr(args, 'app', None)))
@@ -0,0 +1,78 @@
+from logzero import logger
+
+from irods import exception as irods_exception
+from irods.meta import iRODSMeta
+from irods.models import DataObject
+
+try:
+    from irods.meta import AVUOperation
+except ImportError:  # python-irodsclient older than 0.8.6
+    AVUOperation = None
+
+# raised by servers older than 4.2.8, which lack the atomic metadata API
+UNSUPPORTED = getattr(irods_exception, 'SYS_UNMATCHED_API_NUM', None)
+# raised when adding an AVU the object already has
+DUPLICATE = irods_exception.CATALOG_ALREADY_HAS_ITEM_BY_THAT_NAME
+
+
+class MetadataWriter(object):
+    '''
+    Collects the AVUs for validated objects and writes each object's set in
+    one atomic metadata call, so a file is never left tagged 'validated'
+    with only part of its header values. Objects are queued and flushed
+    together once batch_size of them are waiting, and at the end of a run.
+    '''
+
+    def __init__(self, batch_size=50):
+        self.batch_size = batch_size
+        self.queue = []
+        self.written = 0
+        self.failed = 0
+
+    def add(self, session, path, avus):
+        '''
+        Queues avus, a list of (name, value) pairs, for the object at path
+        '''
+
+        self.queue.append((session, path, avus))
+        if len(self.queue) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        queue, self.queue = self.queue, []
+        for session, path, avus in queue:
+            try:
+                apply_avus(session, path, avus)
+                self.written += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error("could not write metadata for " + path)
+                logger.exception(e)
+        if len(queue) > 0:
+            logger.debug("metadata written for %d objects (%d failed so far)"
+                         % (len(queue), self.failed))
+
+
+def apply_avus(session, path, avus):
+    '''
+    Adds every AVU to the data object at path in a single atomic request. Servers without atomic
+    metadata support get one add per AVU with 'validated' written last, so
+    an interrupted write leaves the file to be validated again next run;
+    AVUs that run already wrote count as written.
+    '''
+
+    if AVUOperation is not None:
+        operations = [AVUOperation(operation='add', avu=iRODSMeta(name, value))
+                      for name, value in avus]
+        try:
+            session.metadata.apply_atomic_operations(DataObject, path, *operations)
+            return
+        except Exception as e:
+            if UNSUPPORTED is None or not isinstance(e, UNSUPPORTED):
+                raise
+
+    for name, value in sorted(avus, key=lambda avu: avu[0] == 'validated'):
+        try:
+            session.metadata.add(DataObject, path, iRODSMeta(name, value))
+        except DUPLICATE:
+            pass
@@ -0,0 +1,293 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from logzero import logger
+
+import storage
+
+
+# upper bounds in seconds of the histogram buckets, Prometheus style
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+HELP = {
+    'verssa_phase_seconds': "Time spent in each phase of a run",
+    'verssa_plugin_seconds': "Time spent in a module's plugin_main",
+    'verssa_validation_step_seconds': "Time spent per file in each validation step",
+    'verssa_terrain_request_seconds': "Terrain HTTP request latency",
+    'verssa_irods_call_seconds': "iRODS call latency",
+}
+
+# path segments that are ids rather than part of the route
+ID_SEGMENT = re.compile(r"^([0-9a-f]{8}-[0-9a-f-]{27}|\d+)$")
+
+# everything below is a no-op until enable() is called
+enabled = False
+script = None
+started = None
+_histograms = {}
+_lock = threading.Lock()
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(BUCKETS) and value > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        '''
+        Upper bound of the bucket holding the q-th observation
+        '''
+
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n > 0:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return 0.0
+
+
+def enable(name):
+    '''
+    Starts recording for the script called name
+    '''
+
+    global enabled, script, started
+    enabled = True
+    script = name
+    started = time.time()
+
+
+def observe(metric, seconds, **labels):
+    if not enabled:
+        return
+    key = (metric, tuple(sorted(labels.items())))
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = Histogram()
+        h.observe(seconds)
+
+
+class _Timer(object):
+
+    def __init__(self, metric, labels):
+        self.metric = metric
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.metric, time.perf_counter() - self.start, **self.labels)
+
+
+@contextmanager
+def _nothing():
+    yield
+
+
+def timer(metric, **labels):
+    '''
+    Context manager timing its block into metric
+    '''
+
+    if not enabled:
+        return _nothing()
+    return _Timer(metric, labels)
+
+
+def timed(phase):
+    '''
+    Decorator timing every call of a phase function
+    '''
+
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            with _Timer('verssa_phase_seconds', {'phase': phase}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def route(url):
+    path = url.split("?", 1)[0].split("/terrain", 1)[-1]
+    return "/".join("{id}" if ID_SEGMENT.match(part) else part for part in path.split("/"))
+
+
+def record_response(response, *args, **kwargs):
+    '''
+    requests response hook for the Terrain session
+    '''
+
+    if enabled:
+        observe('verssa_terrain_request_seconds', response.elapsed.total_seconds(),
+                method=response.request.method, route=route(response.url),
+                status="%dxx" % (response.status_code // 100))
+
+
+class _Timed(object):
+    '''
+    Proxy that times every method call of target as op "<name>.<method>"
+    '''
+
+    def __init__(self, target, name):
+        self._target = target
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(self._target, attr)
+        if not callable(value):
+            return value
+        op = self._name + "." + attr
+
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return value(*args, **kwargs)
+            finally:
+                observe('verssa_irods_call_seconds', time.perf_counter() - start, op=op)
+        return call
+
+
+class _TimedQuery(object):
+    '''
+    GenQuery builder whose result pages are timed as they are fetched
+    '''
+
+    def __init__(self, query):
+        self._query = query
+
+    def filter(self, *criteria):
+        return _TimedQuery(self._query.filter(*criteria))
+
+    def order_by(self, *args, **kwargs):
+        return _TimedQuery(self._query.order_by(*args, **kwargs))
+
+    def get_batches(self, *args, **kwargs):
+        pages = iter(self._query.get_batches(*args, **kwargs))
+        while True:
+            start = time.perf_counter()
+            try:
+                page = next(pages)
+            except StopIteration:
+                return
+            observe('verssa_irods_call_seconds', time.perf_counter() - start, op="query.page")
+            yield page
+
+    def __getattr__(self, attr):
+        return getattr(self._query, attr)
+
+
+class TimedSession(object):
+    '''
+    iRODS session wrapper recording how long data object, metadata,
+    collection and query calls take
+    '''
+
+    def __init__(self, session):
+        self._session = session
+        self.data_objects = _Timed(session.data_objects, "data_objects")
+        self.metadata = _Timed(session.metadata, "metadata")
+        self.collections = _Timed(session.collections, "collections")
+
+    def query(self, *columns):
+        return _TimedQuery(self._session.query(*columns))
+
+    def __getattr__(self, attr):
+        return getattr(self._session, attr)
+
+    def __enter__(self):
+        self._session.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._session.__exit__(*exc)
+
+
+def instrument_irods(session):
+    '''
+    The session itself when metrics are off, else a TimedSession around it
+    '''
+
+    return TimedSession(session) if enabled else session
+
+
+def _labels(labels, extra=()):
+    pairs = [('script', script)] + list(labels) + list(extra)
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in pairs) + "}"
+
+
+def prometheus_text():
+    with _lock:
+        items = sorted((key, (list(h.counts), h.total, h.count)) for key, h in _histograms.items())
+
+    lines = []
+    last_metric = None
+    for (metric, labels), (counts, total, count) in items:
+        if metric != last_metric:
+            lines.append("# HELP %s %s" % (metric, HELP.get(metric, metric)))
+            lines.append("# TYPE %s histogram" % metric)
+            last_metric = metric
+        cumulative = 0
+        for bound, n in zip(list(BUCKETS) + ["+Inf"], counts):
+            cumulative += n
+            lines.append("%s_bucket%s %d" % (metric, _labels(labels, [('le', bound)]), cumulative))
+        lines.append("%s_sum%s %f" % (metric, _labels(labels), total))
+        lines.append("%s_count%s %d" % (metric, _labels(labels), count))
+    lines.append("# TYPE verssa_last_run_timestamp_seconds gauge")
+    lines.append("verssa_last_run_timestamp_seconds%s %d" % (_labels([]), time.time()))
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    with _lock:
+        items = sorted(_histograms.items())
+    out = {'script': script, 'started': started, 'finished': time.time(), 'metrics': {}}
+    for (metric, labels), h in items:
+        out['metrics'].setdefault(metric, []).append({
+            'labels': dict(labels),
+            'count': h.count,
+            'sum': round(h.total, 6),
+            'p50': h.quantile(0.5),
+            'p95': h.quantile(0.95),
+            'max': round(h.max, 6),
+        })
+    return out
+
+
+def write(directory):
+    '''
+    Writes <directory>/verssa_<script>.prom for the node exporter's textfile
+    collector and <directory>/verssa-<script>-summary.json
+    '''
+
+    if not enabled:
+        return
+    try:
+        storage.write_atomic(os.path.join(directory, "verssa_%s.prom" % script), prometheus_text())
+        storage.write_atomic(os.path.join(directory, "verssa-%s-summary.json" % script),
+               json.dumps(summary(), indent=2))
+    except (IOError, OSError) as e:
+        logger.error("could not write metrics to %s: %s" % (directory, e))
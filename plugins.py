@@ -0,0 +1,136 @@
+import importlib
+import importlib.util
+import os
+from collections import namedtuple
+
+from logzero import logger
+
+import appcache
+import submit
+
+
+ANALYSES_DIR = "/iplant/home/shared/ssa-arizona/demo/analyses"
+
+# the app's own input parameter in AppSpec.params
+INPUT = "input"
+
+# search: app search string, as listed in the DE
+# job_name: analysis name
+# output_dir: where the DE writes the results
+# params: parameter id -> value; INPUT stands for the app's input parameter
+#   and string values may use {path} and {name} of the data object
+AppSpec = namedtuple('AppSpec', ['search', 'job_name', 'output_dir', 'params', 'debug', 'notify'],
+                     defaults=(ANALYSES_DIR, {INPUT: "{path}"}, False, True))
+
+# file extension -> app run on files of that type
+APPS = {
+    'qmg': AppSpec("Quaternion Classifier (Verssa)", "QuaternionClassifierAutomation"),
+    'bmg2': AppSpec("Behavior Classifier (Verssa)", "BehaviorClassifierAutomation"),
+    'pmg2': AppSpec("Power State Classifier (Verssa)", "PowerStateClassifierAutomation"),
+    'fdata': AppSpec("Turboprop Filter (Verssa)", "TurboPropFilterAutomation"),
+}
+
+# a module in this directory named after an extension (xyz.py for .xyz) and
+# defining plugin_main(args) handles types not in APPS
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# extension -> AppSpec, plugin module, or None for types nothing handles;
+# filled in as extensions are first seen
+_dispatch = dict(APPS)
+
+
+def find_module(ftype):
+    '''
+    The plugin module for ftype, or None. Only modules in PLUGIN_DIR count,
+    so a standard library or installed package named like an extension is
+    never picked up.
+    '''
+
+    if not ftype.isidentifier():
+        return None
+    spec = importlib.util.find_spec(ftype)
+    if spec is None or spec.origin is None or \
+            os.path.dirname(os.path.abspath(spec.origin)) != PLUGIN_DIR:
+        return None
+    module = importlib.import_module(ftype)
+    if not callable(getattr(module, 'plugin_main', None)):
+        return None
+    return module
+
+
+def handler(ftype):
+    '''
+    What runs files of type ftype, looked up once per extension
+    '''
+
+    if ftype not in _dispatch:
+        try:
+            _dispatch[ftype] = find_module(ftype)
+        except Exception as e:
+            logger.error("could not load the module for .%s files: %s" % (ftype, e))
+            _dispatch[ftype] = None
+    return _dispatch[ftype]
+
+
+def supported(ftype):
+    return handler(ftype) is not None
+
+
+def build_request(spec, app, obj):
+    '''
+    The /terrain/analyses body for running spec's app on obj
+    '''
+
+    config = {}
+    for key, value in spec.params.items():
+        if isinstance(value, str):
+            value = value.format(path=obj.path, name=obj.name)
+        config[app["parameter_id"] if key == INPUT else key] = value
+
+    return {
+        "config": config,
+        "name": spec.job_name,
+        "app_id": app["app_id"],
+        "system_id": app["system_id"],
+        "debug": spec.debug,
+        "output_dir": spec.output_dir,
+        "notify": spec.notify
+    }
+
+
+def submission_for(spec, obj, auth_headers):
+    app = appcache.cache.lookup(spec.search, auth_headers)
+    return submit.Submission(obj.path, spec.search, build_request(spec, app, obj))
+
+
+def run(spec, args):
+    '''
+    plugin_main for an AppSpec: the analysis request for args['obj'], handed
+    back as a submit.Submission if args['defer'] is set, posted otherwise.
+    With defer errors are raised so the caller can count the file as not
+    submitted; otherwise they are logged and give None, as plugin modules
+    always did.
+    '''
+
+    if args.get('defer'):
+        # the submission stage in automate.py posts it
+        return submission_for(spec, args['obj'], args['auth_headers'])
+
+    logger_ = args.get('logger', logger)
+    try:
+        submission = submission_for(spec, args['obj'], args['auth_headers'])
+        submit.post_one(submission, args['auth_headers'], args['db'], logger_)
+    except Exception as e:
+        logger_.exception(e)
+
+
+def call(ftype, args):
+    '''
+    Runs the handler for ftype on args (the dict documented for modules);
+    returns what the handler returns
+    '''
+
+    found = handler(ftype)
+    if isinstance(found, AppSpec):
+        return run(found, args)
+    return found.plugin_main(args)
@@ -0,0 +1,63 @@
+import random
+
+
+# most analyses polled in one cycle, however many are in flight
+POLL_BUDGET = 200
+
+# (age in seconds, seconds between polls) per status: a job is polled at
+# the interval of the first row its age is below
+SUBMITTED_INTERVALS = [
+    (10 * 60, 30),
+    (60 * 60, 120),
+    (24 * 60 * 60, 600),
+    (None, 1800),
+]
+RUNNING_INTERVALS = [
+    (10 * 60, 60),
+    (60 * 60, 180),
+    (24 * 60 * 60, 600),
+    (None, 1800),
+]
+
+ERROR_BACKOFF_BASE = 60
+ERROR_BACKOFF_MAX = 60 * 60
+
+
+def poll_interval(job, now):
+    '''
+    Seconds until a job should be polled again, from its age and last status:
+    fresh jobs are checked often, long-running or long-queued ones rarely
+    '''
+
+    age = now - (job.get('submitted_at') or now)
+    table = SUBMITTED_INTERVALS if job.get('status') == 'Submitted' else RUNNING_INTERVALS
+    for max_age, interval in table:
+        if max_age is None or age < max_age:
+            return interval
+    return table[-1][1]
+
+
+def error_backoff(errors):
+    '''
+    Exponential backoff with jitter after errors consecutive failed polls
+    '''
+
+    delay = min(ERROR_BACKOFF_MAX, ERROR_BACKOFF_BASE * (2 ** (errors - 1)))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def schedule_success(job, status, now):
+    job['status'] = status
+    job['poll_errors'] = 0
+    job['last_polled_at'] = now
+    job['next_poll_at'] = now + poll_interval(job, now)
+
+
+def schedule_error(job, now):
+    job['poll_errors'] = (job.get('poll_errors') or 0) + 1
+    job['last_polled_at'] = now
+    job['next_poll_at'] = now + error_backoff(job['poll_errors'])
+
+
+def due_jobs(db, now, budget=POLL_BUDGET):
+    return db.due(("Submitted", "Running"), now, budget)
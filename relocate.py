@@ -0,0 +1,107 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from irods import exception as irods_exception
+from logzero import logger
+
+
+# moves in flight at once, each on its own iRODS connection
+MOVE_WORKERS = 4
+# a move refused for lack of permission is tried again after this long
+# rather than on every cycle
+DENIED_RETRY = 6 * 60 * 60
+
+PERMISSION_ERRORS = (
+    irods_exception.CAT_NO_ACCESS_PERMISSION,
+    irods_exception.CAT_INSUFFICIENT_PRIVILEGE_LEVEL,
+    irods_exception.SYS_NO_DATA_OBJ_PERMISSION,
+    irods_exception.SYS_NO_PATH_PERMISSION,
+    irods_exception.USER_ACCESS_DENIED,
+)
+
+
+class SessionPool(object):
+    '''
+    Up to size iRODS sessions made by factory on first use and handed out
+    to one thread at a time
+    '''
+
+    def __init__(self, factory, size=MOVE_WORKERS):
+        self.factory = factory
+        self.size = size
+        self.idle = queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def session(self):
+        try:
+            s = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                make = self.created < self.size
+                if make:
+                    self.created += 1
+            if make:
+                try:
+                    s = self.factory()
+                except Exception:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+            else:
+                s = self.idle.get()
+        try:
+            yield s
+        finally:
+            self.idle.put(s)
+
+    def close(self):
+        while True:
+            try:
+                s = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            s.cleanup()
+        self.created = 0
+
+
+def move_one(pool, name, dest):
+    with pool.session() as s:
+        s.data_objects.move(name, dest)
+
+
+def move_all(names, dest, pool, workers=None):
+    '''
+    Moves every data object in names into dest, at most workers at a time.
+    Returns the names moved, the names refused for lack of permission and
+    the names that failed for any other reason (worth retrying soon).
+    '''
+
+    moved, denied, failed = [], [], []
+    if len(names) == 0:
+        return moved, denied, failed
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers or pool.size) as executor:
+        futures = [(name, executor.submit(move_one, pool, name, dest)) for name in names]
+        for name, future in futures:
+            try:
+                future.result()
+                moved.append(name)
+                logger.info("We moved " + name + " into " + dest)
+            except PERMISSION_ERRORS as e:
+                denied.append(name)
+                logger.error("no permission to move %s into %s: %s"
+                             % (name, dest, type(e).__name__))
+            except Exception as e:
+                failed.append(name)
+                logger.error("could not move " + name)
+                logger.exception(e)
+
+    logger.info("moved %d of %d files into %s in %.1fs (%d denied, %d failed)"
+                % (len(moved), len(names), dest, time.time() - start, len(denied), len(failed)))
+    return moved, denied, failed
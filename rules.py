@@ -0,0 +1,80 @@
+import hashlib
+import re
+from collections import namedtuple
+
+
+# key: header keyword
+# kind: 'str' values are matched against pattern, 'float' values must be floats
+# pattern: regex the value has to match from its start (None to skip)
+# required: a missing required key is a violation, a missing optional key isn't
+Rule = namedtuple('Rule', ['key', 'kind', 'pattern', 'required'])
+
+SEXAGESIMAL = r"-?\d+ -?\d+ -?\d+"
+
+HEADER_RULES = [
+    #2019-05-05T03:25:53.30(:)
+    Rule('DATE-OBS', 'str', r"\d\d\d\d-\d\d-\d\dT\d\d:\d\d:\d\d.*", True),
+    Rule('EXPTIME', 'float', None, True),
+    Rule('OBJCTRA', 'str', SEXAGESIMAL, True),
+    Rule('OBJCTDEC', 'str', SEXAGESIMAL, True),
+    Rule('SITELAT', 'str', SEXAGESIMAL, True),
+    Rule('SITELONG', 'str', SEXAGESIMAL, True),
+    Rule('SITEELEV', 'str', r"-?\d+\.?\d+", True),
+    Rule('TELESCOP', 'str', r".+", True),
+    Rule('COUNTRY', 'str', r"...", True),
+]
+
+
+class RuleSet(object):
+    '''
+    A rule table with its patterns compiled once, reused for every header
+    checked in the run
+    '''
+
+    def __init__(self, rules=HEADER_RULES):
+        self.rules = [(rule, re.compile(rule.pattern) if rule.pattern else None)
+                      for rule in rules]
+
+    def fingerprint(self):
+        '''
+        Changes whenever the rules do, for caches of earlier verdicts
+        '''
+
+        return hashlib.sha1(repr([rule for rule, _ in self.rules]).encode()).hexdigest()
+
+    def keys(self):
+        return [rule.key for rule, _ in self.rules]
+
+    def check(self, hdr, filename=""):
+        '''
+        Evaluates every rule against hdr and returns all violations as a
+        list of messages; an empty list means the header is valid
+        '''
+
+        violations = []
+        for rule, pattern in self.rules:
+            if rule.key not in hdr:
+                if rule.required:
+                    violations.append("ERROR: missing header " + rule.key + " for: " + filename)
+                continue
+
+            value = hdr[rule.key]
+            if rule.kind == 'float':
+                ok = isinstance(value, float)
+            else:
+                ok = not isinstance(value, bool) and pattern.match(str(value)) is not None
+
+            if not ok:
+                violations.append("Error " + rule.key + " bad match")
+        return violations
+
+    def check_many(self, headers):
+        '''
+        Checks a batch of already parsed headers, given as (filename, hdr)
+        pairs, and returns a dict of filename -> violations
+        '''
+
+        return dict((filename, self.check(hdr, filename)) for filename, hdr in headers)
+
+
+default_rules = RuleSet()
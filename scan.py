@@ -0,0 +1,173 @@
+import calendar
+import json
+import os
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from irods.column import Like
+from irods.models import Collection, DataObject
+from logzero import logger
+
+import storage
+
+
+# a delta scan re-reads this many seconds before the watermark, so objects
+# finished in the same second as the last scan aren't missed; callers
+# already skip what they have seen
+SCAN_OVERLAP = 120
+# moving a file into a collection keeps its old modify time, which a delta
+# scan can't see, so every collection is fully rescanned this often
+FULL_SCAN_INTERVAL = 60 * 60
+
+# one data object as returned by the scan query; checksum is the catalog's
+# (empty if it was never computed)
+ScannedObject = namedtuple('ScannedObject', ['id', 'path', 'name', 'collection', 'modify_time',
+                                             'checksum', 'size'], defaults=(None, None))
+
+
+def to_epoch(value):
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple())
+    return int(value)
+
+
+class Watermarks(object):
+    '''
+    Per-collection scan state saved between runs: the newest modify time
+    seen so far and when the last full scan finished
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.marks = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.marks = json.load(f)
+            except (IOError, OSError, ValueError) as e:
+                logger.error("could not read %s, doing full scans: %s" % (path, e))
+
+    def get(self, collection):
+        return self.marks.get(collection)
+
+    def set(self, collection, modify_time, full_scan_at=None):
+        state = self.marks.setdefault(collection, {'modify_time': 0, 'full_scan_at': 0})
+        state['modify_time'] = max(state['modify_time'], modify_time)
+        if full_scan_at is not None:
+            state['full_scan_at'] = full_scan_at
+
+    def save(self):
+        storage.write_json(self.path, self.marks)
+
+
+class DeltaScan(object):
+    '''
+    Streams the data objects of a collection (or, with recursive, of every
+    collection below it) from paged GenQuery results. Unless a full scan is
+    due or forced, only objects modified since the watermark are returned.
+    Call commit() once everything yielded has been handled to move the
+    watermark forward.
+
+    Objects come back ordered by collection and name. A scan that can't be
+    finished in one run saves cursor(obj) for the last object it handled;
+    passing that back as cursor continues the same scan right after it.
+    '''
+
+    def __init__(self, session, collection, watermarks, recursive=False, full=None, cursor=None):
+        self.session = session
+        self.collection = collection
+        self.watermarks = watermarks
+        self.recursive = recursive
+        self.started = time.time()
+        self.resume_after = None
+
+        state = watermarks.get(collection)
+        self.newest = 0 if state is None else state['modify_time']
+        if cursor is not None:
+            self.started = cursor['started']
+            self.full = cursor['full']
+            self.since = cursor['since']
+            self.newest = max(self.newest, cursor['newest'])
+            self.resume_after = (cursor['collection'], cursor['name'])
+        else:
+            if full is None:
+                full = state is None or self.started - state['full_scan_at'] >= FULL_SCAN_INTERVAL
+            self.full = full
+            self.since = None if full else max(0, state['modify_time'] - SCAN_OVERLAP)
+        self.count = 0
+
+    def base_query(self):
+        q = self.session.query(DataObject.id, DataObject.name, DataObject.modify_time,
+                               DataObject.checksum, DataObject.size, Collection.name)
+        if self.recursive:
+            q = q.filter(Like(Collection.name, self.collection + "/%"))
+        else:
+            q = q.filter(Collection.name == self.collection)
+        if self.since is not None:
+            q = q.filter(DataObject.modify_time >= datetime.utcfromtimestamp(self.since))
+        return q
+
+    def queries(self):
+        '''
+        The GenQueries for this scan, in order. When resuming, one covers the
+        rest of the cursor's collection and one the collections after it.
+        The comparisons run in the catalog, so they follow the same
+        collation as its ORDER BY.
+        '''
+
+        if self.resume_after is None:
+            return [self.base_query().order_by(Collection.name).order_by(DataObject.name)]
+        collection, name = self.resume_after
+        rest = self.base_query().filter(Collection.name == collection).filter(DataObject.name > name)
+        after = self.base_query().filter(Collection.name > collection)
+        return [rest.order_by(DataObject.name),
+                after.order_by(Collection.name).order_by(DataObject.name)]
+
+    def __iter__(self):
+        logger.debug("%s scan of %s%s" % ("full" if self.full else "delta", self.collection,
+                                            "" if self.since is None else " since %d" % self.since))
+        seen = set()
+        for query in self.queries():
+            for batch in query.get_batches():
+                for row in batch:
+                    # one row per replica
+                    if row[DataObject.id] in seen:
+                        continue
+                    seen.add(row[DataObject.id])
+
+                    modify_time = to_epoch(row[DataObject.modify_time])
+                    self.newest = max(self.newest, modify_time)
+                    self.count += 1
+                    yield ScannedObject(row[DataObject.id],
+                                        row[Collection.name] + "/" + row[DataObject.name],
+                                        row[DataObject.name], row[Collection.name], modify_time,
+                                        row[DataObject.checksum], row[DataObject.size])
+
+    def cursor(self, obj):
+        '''
+        Everything needed to resume this scan after obj in a later run
+        '''
+
+        return {
+            'collection': obj.collection,
+            'name': obj.name,
+            'full': self.full,
+            'since': self.since,
+            'started': self.started,
+            'newest': self.newest,
+        }
+
+    def commit(self):
+        '''
+        Moves the watermark up to the newest modify time seen, but never past
+        the start of the pass: a pass resumed over several runs has already
+        gone by collections that got new files since, and those files are
+        older than the newest ones seen later on
+        '''
+
+        self.watermarks.set(self.collection, min(self.newest, self.started) - SCAN_OVERLAP,
+                            self.started if self.full else None)
+        self.watermarks.save()
+        logger.debug("%s scan of %s returned %d objects"
+                     % ("full" if self.full else "delta", self.collection, self.count))
@@ -0,0 +1,114 @@
+import json
+import os
+import sqlite3
+
+
+def write_atomic(path, text, mode=0o666):
+    '''
+    Replaces the file at path with text. It is written to path.tmp first and
+    renamed over path, so readers and crashes never see half a file. mode
+    (less the umask) applies when the file is created.
+    '''
+
+    tmp_path = path + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_json(path, data, mode=0o666):
+    write_atomic(path, json.dumps(data), mode)
+
+
+def open_sqlite(path):
+    '''
+    Connection to the SQLite file at path in autocommit mode (callers open
+    their own transactions) and WAL, usable from any thread
+    '''
+
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class PostgresConnection(object):
+    '''
+    A psycopg2 connection in autocommit mode with the part of the sqlite3
+    connection API the stores use (execute and executemany with ?
+    placeholders), so one store class serves both databases
+    '''
+
+    def __init__(self, url):
+        try:
+            import psycopg2
+        except ImportError:
+            raise RuntimeError("a PostgreSQL database_url needs psycopg2 (pip install psycopg2-binary)")
+        self.conn = psycopg2.connect(url)
+        self.conn.autocommit = True
+
+    def execute(self, sql, params=()):
+        cur = self.conn.cursor()
+        cur.execute(sql.replace("?", "%s"), tuple(params))
+        return cur
+
+    def executemany(self, sql, rows):
+        cur = self.conn.cursor()
+        cur.executemany(sql.replace("?", "%s"), [tuple(row) for row in rows])
+        return cur
+
+    def close(self):
+        self.conn.close()
+
+
+def is_postgres(target):
+    '''
+    True for a postgresql:// URL or a connection made from one
+    '''
+
+    if isinstance(target, PostgresConnection):
+        return True
+    return isinstance(target, str) and target.startswith(("postgresql://", "postgres://"))
+
+
+def connect(target):
+    '''
+    Connection for a SQLite file path or a PostgreSQL URL
+    '''
+
+    if is_postgres(target):
+        return PostgresConnection(target)
+    return open_sqlite(target)
+
+
+def begin(conn):
+    '''
+    Opens a write transaction: SQLite takes its write lock up front so two
+    writers can't deadlock upgrading a read lock
+    '''
+
+    conn.execute("BEGIN" if is_postgres(conn) else "BEGIN IMMEDIATE")
+
+
+def column_names(conn, table):
+    if is_postgres(conn):
+        return set(row[0] for row in conn.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = ?", (table,)))
+    return set(row[1] for row in conn.execute("PRAGMA table_info(%s)" % table))
+
+
+def column_type(conn, decl):
+    '''
+    A SQLite column declaration for conn's database. PostgreSQL's REAL is
+    single precision, too coarse for epoch seconds.
+    '''
+
+    if is_postgres(conn):
+        return decl.replace("REAL", "DOUBLE PRECISION")
+    return decl
+
+
+def dict_rows(cursor):
+    names = [d[0] for d in cursor.description]
+    return [dict(zip(names, row)) for row in cursor]
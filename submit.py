@@ -0,0 +1,174 @@
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from logzero import logger
+
+import appcache
+import ledger
+import terrain
+
+
+SUBMIT_WORKERS = 8
+# sustained submissions per second and how many may go out back to back
+SUBMIT_RATE = 5.0
+SUBMIT_BURST = 10
+SUBMIT_RETRIES = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+# new jobs are written to the job store this many at a time
+RECORD_BATCH = 50
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# what a plugin hands back instead of posting the analysis itself:
+# name is the iRODS path of the input, search the app search string the
+# body was built from, body the /terrain/analyses request. A batch of files
+# submitted as one analysis lists its input paths in members and uses the
+# batch name as name.
+Submission = namedtuple('Submission', ['name', 'search', 'body', 'members'],
+                        defaults=(None,))
+
+
+class TokenBucket(object):
+    '''
+    Thread-safe token bucket: acquire() blocks until a request may go out
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def retry_delay(attempt, response=None):
+    '''
+    Exponential backoff with full jitter, or the server's Retry-After
+    '''
+
+    if response is not None and response.headers.get("Retry-After", "").isdigit():
+        return float(response.headers["Retry-After"])
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+def post(submission, auth_headers, bucket=None, retries=SUBMIT_RETRIES):
+    '''
+    Posts one analysis, retrying 429/5xx responses and connection errors.
+    Returns the Terrain response body.
+    '''
+
+    for attempt in range(retries + 1):
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            r = terrain.http().post(terrain.url("/analyses"), headers=auth_headers,
+                                    json=submission.body)
+        except requests.ConnectionError:
+            if attempt == retries:
+                raise
+            time.sleep(retry_delay(attempt))
+            continue
+
+        if r.status_code in RETRY_STATUSES and attempt < retries:
+            logger.debug("submission of %s got %d, retrying" % (submission.name, r.status_code))
+            time.sleep(retry_delay(attempt, r))
+            continue
+
+        if r.status_code >= 400 and r.status_code not in RETRY_STATUSES:
+            # the cached descriptor may be stale (app updated or re-published)
+            appcache.cache.invalidate(submission.search)
+        r.raise_for_status()
+        return r.json()
+
+
+def new_entries(submission, rj):
+    '''
+    Job store entries for a posted submission: one per input file, all with
+    the same analysis id
+    '''
+
+    if submission.members is None:
+        return [{
+            'status': rj["status"],
+            'id': rj["id"],
+            'name': submission.name
+        }]
+    return [{
+        'status': rj["status"],
+        'id': rj["id"],
+        'name': member,
+        'batch': submission.name
+    } for member in submission.members]
+
+
+def post_one(submission, auth_headers, db, logger=logger):
+    '''
+    Submits right away and records the job; used by plugins called the old
+    way, without a submission stage
+    '''
+
+    entries = new_entries(submission, post(submission, auth_headers))
+    db.insert_many(entries)
+    ledger.record_many([('submitted', e['name'], None) for e in entries])
+    logger.info("added new entry with name " + submission.name)
+
+
+def submit_all(submissions, auth_headers, db, workers=None, rate=None, burst=None):
+    '''
+    Posts the submissions with at most workers in flight and no more than
+    rate per second (SUBMIT_* by default), recording new jobs in the db in
+    batches. Returns the number submitted and the number that failed.
+    '''
+
+    if len(submissions) == 0:
+        return 0, 0
+
+    workers = workers or SUBMIT_WORKERS
+    bucket = TokenBucket(rate or SUBMIT_RATE, burst or SUBMIT_BURST)
+    pending = []
+    submitted = 0
+    failed = 0
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(post, s, auth_headers, bucket), s) for s in submissions)
+        for future in as_completed(futures):
+            submission = futures[future]
+            try:
+                entries = new_entries(submission, future.result())
+                ledger.record_many([('submitted', e['name'], None) for e in entries])
+                pending.extend(entries)
+                submitted += 1
+                logger.info("added new entry with name " + submission.name)
+            except Exception as e:
+                failed += 1
+                logger.error("could not submit " + submission.name)
+                logger.exception(e)
+
+            if len(pending) >= RECORD_BATCH:
+                db.insert_many(pending)
+                pending = []
+
+    if len(pending) > 0:
+        db.insert_many(pending)
+
+    logger.info("submitted %d analyses (%d failed) in %.1fs"
+                % (submitted, failed, time.time() - start))
+    return submitted, failed
@@ -0,0 +1,181 @@
+import json
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from logzero import logger
+
+import metrics
+import storage
+
+
+BASE_URL = "https://de.cyverse.org/terrain"
+STATUS_CHUNK_SIZE = 50
+
+# refresh this many seconds before the token runs out
+TOKEN_REFRESH_MARGIN = 300
+# assumed lifetime when Terrain doesn't say
+DEFAULT_TOKEN_LIFETIME = 3600
+# where a token is kept between runs, so most runs don't have to log in
+TOKEN_FILE = "terrain-token.json"
+# (connect, read) seconds for every Terrain request that doesn't set its own,
+# so a hung connection can't stall the daemon or the submit threads
+REQUEST_TIMEOUT = (10, 60)
+
+_http = None
+
+
+class TimeoutAdapter(HTTPAdapter):
+    '''
+    HTTPAdapter that applies REQUEST_TIMEOUT when the caller gives none
+    '''
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = REQUEST_TIMEOUT
+        return super(TimeoutAdapter, self).send(request, **kwargs)
+
+
+def http():
+    '''
+    Returns the process-wide requests session so every Terrain call reuses
+    the same pooled keep-alive connections
+    '''
+
+    global _http
+    if _http is None:
+        _http = requests.Session()
+        adapter = TimeoutAdapter(pool_connections=4, pool_maxsize=16)
+        _http.mount("https://", adapter)
+        _http.mount("http://", adapter)
+        _http.hooks['response'].append(metrics.record_response)
+    return _http
+
+
+def url(path):
+    return BASE_URL + path
+
+
+class TokenManager(object):
+    '''
+    Holds the Terrain bearer token and renews it shortly before it expires.
+    headers is updated in place, so anything holding on to it (plugins, the
+    daemon loop) always sends the current token.
+
+    With a cache_path the token and its expiry are saved there (readable by
+    the owner only) and reused by later runs until they are about to expire.
+    '''
+
+    def __init__(self, username, password, margin=TOKEN_REFRESH_MARGIN, cache_path=None):
+        self.username = username
+        self.password = password
+        self.margin = margin
+        self.cache_path = cache_path
+        self.headers = {}
+        self.expires_at = 0
+        self.load()
+        http().hooks['response'].append(self.check_rejected)
+
+    def load(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path) as f:
+                saved = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            logger.error("could not read %s: %s" % (self.cache_path, e))
+            return
+        if saved.get('username') != self.username:
+            return
+        self.headers["Authorization"] = "Bearer " + saved['access_token']
+        self.expires_at = saved['expires_at']
+
+    def save(self, token):
+        if not self.cache_path:
+            return
+        storage.write_json(self.cache_path, {'username': self.username, 'access_token': token,
+                                             'expires_at': self.expires_at}, mode=0o600)
+
+    def check_rejected(self, response, *args, **kwargs):
+        '''
+        A 401 for our token means it was revoked early: forget it so the
+        next ensure_fresh() logs in again
+        '''
+
+        if (response.status_code == 401 and self.expires_at > 0
+                and response.request.headers.get("Authorization") == self.headers.get("Authorization")):
+            logger.info("Terrain rejected the token, will fetch a new one")
+            self.expires_at = 0
+            if self.cache_path and os.path.exists(self.cache_path):
+                os.remove(self.cache_path)
+
+    def refresh(self):
+        r = http().get(url("/token"), auth=(self.username, self.password))
+        r.raise_for_status()
+        body = r.json()
+        self.headers["Authorization"] = "Bearer " + body['access_token']
+        self.expires_at = time.time() + body.get('expires_in', DEFAULT_TOKEN_LIFETIME)
+        logger.debug("fetched a new Terrain token")
+        try:
+            self.save(body['access_token'])
+        except (IOError, OSError) as e:
+            logger.error("could not save the Terrain token: %s" % e)
+
+    def ensure_fresh(self):
+        '''
+        Renews the token if it expires within the margin; returns headers
+        '''
+
+        if time.time() >= self.expires_at - self.margin:
+            self.refresh()
+        return self.headers
+
+
+def fetch_statuses(ids, auth_headers, chunk_size=STATUS_CHUNK_SIZE):
+    '''
+    Looks up the current status of many analyses at once through the
+    analyses listing filtered by id. Returns a dict of id -> status; ids the
+    listing doesn't return are looked up one at a time via their history.
+    Ids in a chunk whose listing request failed are left out.
+    '''
+
+    statuses = {}
+    unreachable = set()
+    ids = list(ids)
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        id_filter = [{"field": "id", "value": analysis_id} for analysis_id in chunk]
+        params = {"filter": json.dumps(id_filter), "limit": len(chunk)}
+        try:
+            r = http().get(url("/analyses"), headers=auth_headers, params=params)
+            r.raise_for_status()
+            for analysis in r.json().get("analyses", []):
+                if analysis.get("id") in chunk:
+                    statuses[analysis["id"]] = analysis["status"]
+        except Exception as e:
+            # leave the whole chunk for the next poll rather than hammering
+            # Terrain with one request per id while it is failing
+            logger.exception(e)
+            unreachable.update(chunk)
+
+    for analysis_id in ids:
+        if analysis_id in statuses or analysis_id in unreachable:
+            continue
+        try:
+            statuses[analysis_id] = fetch_history_status(analysis_id, auth_headers)
+        except Exception as e:
+            logger.exception(e)
+
+    return statuses
+
+
+def fetch_history_status(analysis_id, auth_headers):
+    '''
+    Status of a single analysis, from the first step of its history
+    '''
+
+    r = http().get(url("/analyses/{0}/history".format(analysis_id)), headers=auth_headers)
+    r.raise_for_status()
+    logger.debug(r.json())
+    return r.json()['steps'][0]['status']
@@ -1,18 +1,67 @@
-from astropy.io import fits
-import re
 from irods.session import iRODSSession
+from irods.models import Collection, DataObject, DataObjectMeta
+from irods.column import Like
 import logzero
 from logzero import logger
 import auth
+import argparse
+import json
 import logging
 import os
+import subprocess
+import threading
 import time
-
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor, as_completed,
+                                wait, FIRST_COMPLETED)
+
+import fitsstream
+import integrity
+import leases
+import metrics
+import metawrite
+import rules
+import scan
+import storage
+import vcache
 from tendo import singleton
 
 
 error_list = []
 t_end = time.time() + (60 * 4)
+# stop taking new files this long before t_end, leaving time to flush
+# metadata, save the cursor and send the error email
+STOP_MARGIN = 20
+
+VALIDATION_ROOT = "/iplant/home/shared/phantom_echoes/phantom_echoes_MEV1"
+FAILED_DIR = VALIDATION_ROOT + "/validation_failed"
+WATERMARK_FILE = "validation-watermark.json"
+CURSOR_FILE = "validation-cursor.json"
+LOG_FILE = "verssa-validation.log"
+# worker mode: claims on files, shared by every validation worker on this
+# host unless auth.database_url names a PostgreSQL database
+LEASE_FILE = "validation-leases.sqlite"
+
+# only the primary header is checked, so by default just the header blocks
+# are streamed from iRODS. Set this if a rule ever needs the data itself.
+NEEDS_DATA = False
+# stream every file once to check its FITS CHECKSUM/DATASUM keywords and
+# the iRODS catalog checksum (--integrity)
+CHECK_INTEGRITY = False
+
+# header values copied onto a validated object as metadata, in write order
+METADATA_KEYS = ['COUNTRY', 'TELESCOP', 'SITEELEV', 'SITELONG', 'SITELAT',
+                 'OBJCTDEC', 'OBJCTRA', 'EXPTIME', 'DATE-OBS']
+
+metadata_writer = metawrite.MetadataWriter()
+# vcache.ValidationCache, opened by main() unless --no-cache is given
+result_cache = None
+# leases.Leases in worker mode (--worker), None for the single instance
+worker_leases = None
+
+# each worker thread (or process) gets its own iRODS connection
+_worker = threading.local()
+_worker_sessions = []
+_worker_sessions_lock = threading.Lock()
 
 
 def send_error_email():
@@ -20,8 +69,6 @@ def send_error_email():
     Sends an error email will all the errors
     '''
 
-    time_check()
-
     if len(error_list) <= 0:
         return
 
@@ -29,205 +76,531 @@ def send_error_email():
 
     recipient = "toddwickizer@gmail.com"
     #recipient = "ssa@dstl.gov.uk"
-    sender = "-aFrom:NoReply\<noreply@henchard.cyverse.org\>"
+    sender = "-aFrom:NoReply<noreply@henchard.cyverse.org>"
     subject = "Failed to validate FIT file(s)"
     message = " There were a few issues with an effort to validate FITs files: \n\n"
     for error in error_list:
         message = message + error[0] + " has failed. " + error[1] + "\n"
 
-    m = 'echo "' + message + '" | mail -s "'+subject+'" '+sender+' '+recipient+' '
-    os.system(m)
+    # no shell: file names and messages come from uploaded files
+    try:
+        subprocess.run(["mail", "-s", subject, sender, recipient], input=message.encode(),
+                       check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.error("could not send the error email: %s" % e)
+
+
+class OutOfTime(Exception):
+    pass
+
+
+def out_of_time():
+    '''
+    True once there is no longer time to start on another file
+    '''
+
+    return time.time() > t_end - STOP_MARGIN
 
 
 def time_check():
+    '''
+    Abandons the current file (not the run) if the budget is gone
+    '''
 
     if (time.time() > t_end):
-        logger.debug("execution took longer than 5 minutes. Exiting")=
+        raise OutOfTime("execution took longer than the time budget")
+
+
+def load_cursor():
+    if not os.path.exists(CURSOR_FILE):
+        return None
+    try:
+        with open(CURSOR_FILE) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        logger.exception(e)
+        return None
+
+
+def save_cursor(cursor):
+    storage.write_json(CURSOR_FILE, cursor)
+
+
+def clear_cursor():
+    if os.path.exists(CURSOR_FILE):
+        os.remove(CURSOR_FILE)
+
+
+def start_worker(name):
+    '''
+    Runs alongside other validators instead of as the only instance. Files
+    are split by leases in LEASE_FILE, or in auth.database_url for
+    validators on several hosts; each worker keeps its own scan position
+    and log.
+    '''
+
+    global worker_leases, WATERMARK_FILE, CURSOR_FILE, LOG_FILE
+    # the same owner on every run, so a file the last run claimed but ran
+    # out of time for is ours to take straight away
+    owner = leases.worker_owner(name or None, pid=False)
+    try:
+        worker_leases = leases.Leases(getattr(auth, 'database_url', None) or LEASE_FILE, owner)
+    except RuntimeError as e:
+        logger.error(e)
         exit(-1)
+    label = owner.split(":")[0]
+    WATERMARK_FILE = "validation-watermark-%s.json" % label
+    CURSOR_FILE = "validation-cursor-%s.json" % label
+    LOG_FILE = "verssa-validation-%s.log" % label
+    return label
 
 
 def fail_and_move(message, obj, session):
 
-    time_check()
-
     # os.system('echo "' + obj.name + '" has failed. '+ message + ' | mail -s "Failed to validate FITs file" -aFrom:NoReply\<noreply@henchard.cyverse.org\> ssa@dstl.gov.uk')
     error_list.append((obj.name, message))
     # Create an error message
-    err_obj = session.data_objects.create("/iplant/home/shared/phantom_echoes/phantom_echoes_MEV1/validation_failed/"+obj.name+".err")
+    err_obj = session.data_objects.create(FAILED_DIR + "/" + obj.name + ".err")
     with err_obj.open('w') as f:
         f.write(message.encode())
-    session.data_objects.move(obj.path, "/iplant/home/shared/phantom_echoes/phantom_echoes_MEV1/validation_failed")
+    session.data_objects.move(obj.path, FAILED_DIR)
 
 
-singleton.SingleInstance()  # will sys.exit(-1) if other instance is running
+def open_session():
+    return metrics.instrument_irods(iRODSSession(host='data.cyverse.org', port=1247,
+                                                 user=auth.username, password=auth.password,
+                                                 zone='iplant'))
 
 
-try:
-    if ("fix_me" in auth.password):
-        logger.debug("you didn't update the password in auth.py")
-        exit(1)
-    # Setup rotating logfile with 3 rotations, each with a maximum filesize of 1MB:
-    logzero.logfile("verssa-validation.log", maxBytes=1e6, backupCount=3)
-    logzero.loglevel(logging.DEBUG)
-    
-except Exception as e:
-    logger.exception(e)
-    logger.debug("could not setup so we are exiting")
-    exit(-1)
+def worker_session():
+    '''
+    The calling worker's own iRODS session, created on first use
+    '''
 
+    session = getattr(_worker, 'session', None)
+    if session is None:
+        session = open_session()
+        _worker.session = session
+        with _worker_sessions_lock:
+            _worker_sessions.append(session)
+    return session
 
-logger.debug("Starting program")
 
-time_check()
+def close_worker_sessions():
+    with _worker_sessions_lock:
+        for session in _worker_sessions:
+            session.cleanup()
+        del _worker_sessions[:]
 
-with iRODSSession(host='data.cyverse.org', port=1247, user=auth.username, password=auth.password, zone='iplant') as session:
-    coll = session.collections.get("/iplant/home/shared/phantom_echoes/phantom_echoes_MEV1")
-    for col in coll.subcollections:
 
-        time_check()
+def scratch_path():
+    '''
+    Per-worker scratch file for full downloads, so workers never share one
+    '''
 
-        #   skip validation failed folder
-        if ("validation_failed" in str(col)):
-            # for obj in col.data_objects:
-            #     print (obj.name)
-            #     # obj.unlink(force=True)
-            continue
+    return "tmpvalid-%d-%d.fit" % (os.getpid(), threading.get_ident())
 
-        # continue
 
-        for obj in col.data_objects:
-            
-            # If the object already has meta_data
-            vkeys = obj.metadata.get_all('validated')
-            if (len(vkeys) >= 1):
-                continue
+def read_header_full(session, path):
+    '''
+    Downloads the whole object to a scratch file and opens it with astropy.
+    Only needed when a check looks past the primary header.
+    '''
 
-            name = obj.name
+    from astropy.io import fits
+
+    tmp_filename = scratch_path()
+    piece_size = 26214400  # 25 MiB
+    try:
+        with open(tmp_filename, "wb") as new_file:
+            with session.data_objects.open(path, 'r') as cache:
+                while True:
+                    time_check()
+                    piece = cache.read(piece_size)
+                    if not piece:
+                        break  # end of file
+                    new_file.write(piece)
+
+        with fits.open(tmp_filename) as hdul:
+            hdr = hdul[0].header.copy()  # the primary HDU header
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+    return hdr
+
+
+def validate_object(session, obj):
+    '''
+    Reads and checks one object (anything with a path and name, such as a
+    scan.ScannedObject). Returns a result dict for the collector: the
+    object's path, an error message or None, and the header values to store
+    as metadata.
+    '''
 
+    result = {'path': obj.path, 'name': obj.name, 'error': None, 'metadata': None}
+
+    if CHECK_INTEGRITY:
+        try:
+            with metrics.timer('verssa_validation_step_seconds', step='integrity'), \
+                    session.data_objects.open(obj.path, 'r') as f:
+                hdr, problems = integrity.verify(f, getattr(obj, 'checksum', None), time_check)
+        except fitsstream.HeaderError as e:
+            result['error'] = "ERROR: no header info? " + str(e)
+            return result
+        if len(problems) > 0:
+            result['error'] = "; ".join(problems)
+            return result
+    elif NEEDS_DATA:
+        with metrics.timer('verssa_validation_step_seconds', step='download'):
+            hdr = read_header_full(session, obj.path)
+    else:
+        try:
+            with metrics.timer('verssa_validation_step_seconds', step='download'), \
+                    session.data_objects.open(obj.path, 'r') as f:
+                raw = fitsstream.read_header_bytes(f)
+            with metrics.timer('verssa_validation_step_seconds', step='parse'):
+                hdr = fitsstream.parse_header(raw)
+        except fitsstream.HeaderError as e:
+            result['error'] = "ERROR: no header info? " + str(e)
+            return result
+
+    with metrics.timer('verssa_validation_step_seconds', step='rules'):
+        violations = rules.default_rules.check(hdr, obj.name)
+    if len(violations) > 0:
+        result['error'] = "; ".join(violations)
+    else:
+        result['metadata'] = [(key, str(hdr[key])) for key in METADATA_KEYS if key in hdr]
+    return result
+
+
+def cache_version():
+    '''
+    Cached verdicts are only reused while the rules and stored keys match
+    '''
 
-            valid_file = False
-            if (name.endswith('.fit') or name.endswith('.fits')):
-                valid_file = True
+    version = rules.default_rules.fingerprint() + ":" + ",".join(METADATA_KEYS)
+    if CHECK_INTEGRITY:
+        # verdicts made without reading the data don't vouch for it
+        version += ":integrity"
+    return version
 
-            if (not valid_file):
-                continue
-                
-            piece_size = 26214400  # 4 KiB
-            m_chk = False
-            with open("tmpvalid.fit", "wb") as new_file:
-                with obj.open('r') as cache:
-                    t_end = time.time() + (60 * 4)
-                    while time.time() < t_end:
-                        time_check()
-                        piece = cache.read(piece_size)
-
-                        if piece == "":
-                            m_chk = True
-                            break  # end of file
-
-                        if not piece:
-                            m_chk = True
-                            break
-                        
-                        new_file.write(piece)
-
-            if (not m_chk):
-                logger.debug("execution took too long exiting")
-                exit(-1)
-
-            filename = obj.name
-            tmp_filename = "tmpvalid.fit"
-            hdul = fits.open(tmp_filename)
-
-            if (len(hdul) < 0):
-                fail_and_move("ERROR: no header info?", obj, session)
-                continue
-            hdr = hdul[0].header  # the primary HDU header
 
-            if ("DATE-OBS" not in hdr):
-                fail_and_move("ERROR: missing header DATE-OBS for: " + filename, obj, session)
-                continue
-            if ("EXPTIME" not in hdr):
-                fail_and_move("ERROR: missing header EXPTIME for: " + filename, obj, session)
-                continue
-            if ("OBJCTRA" not in hdr):
-                fail_and_move("ERROR: missing header OBJCTRA for: " + filename, obj, session)
-                continue
-            if ("OBJCTDEC" not in hdr):
-                fail_and_move("ERROR: missing header OBJCTDEC for: " + filename, obj, session)
-                continue
-            if ("SITELAT" not in hdr):
-                fail_and_move("ERROR: missing header SITELAT for: " + filename, obj, session)
-                continue
-            if ("SITELONG" not in hdr):
-                fail_and_move("ERROR: missing header SITELONG for: " + filename, obj, session)
-                continue
-            if ("SITEELEV" not in hdr):
-                fail_and_move("ERROR: missing header SITEELEV for: " + filename, obj, session)
-                continue
-            if ("TELESCOP" not in hdr):
-                fail_and_move("ERROR: missing header TELESCOP for: " + filename, obj, session)
-                continue
-            if ("COUNTRY" not in hdr):
-                fail_and_move("ERROR: missing header COUNTRY for: ", obj, session)
-                continue
+def cached_result(obj):
+    '''
+    The result of an earlier check of identical content (same checksum and
+    size), or None if it has to be read
+    '''
 
-            #2019-05-05T03:25:53.30(:)
-            if not re.match(r"\d\d\d\d-\d\d-\d\dT\d\d:\d\d:\d\d.*", hdr['DATE-OBS']):
-                fail_and_move("Error DATE-OBS bad match", obj, session)
-                continue
+    if result_cache is None or not obj.checksum:
+        return None
+    hit = result_cache.get(obj.checksum, obj.size, obj.name)
+    if hit is None:
+        return None
+    error, metadata = hit
+    return {'path': obj.path, 'name': obj.name, 'error': error, 'metadata': metadata,
+            'cached': True}
 
-            if ("float" not in str(type(hdr['EXPTIME']))):
-                fail_and_move("Error EXPTIME bad match", obj, session)
-                continue
 
-            if not re.match(r"-?\d+ -?\d+ -?\d+", hdr['OBJCTRA']):
-                fail_and_move("Error OBJCTRA bad match", obj, session)
-                continue
+def worker_settings():
+    '''
+    The run's settings a worker process needs. Only fork copies the parent's
+    globals; spawn and forkserver start from the module defaults.
+    '''
 
-            if not re.match(r"-?\d+ -?\d+ -?\d+", hdr['OBJCTDEC']):
-                fail_and_move("Error OBJCTDEC bad match", obj, session)
-                continue
+    return {'t_end': t_end, 'NEEDS_DATA': NEEDS_DATA, 'CHECK_INTEGRITY': CHECK_INTEGRITY}
 
-            if not re.match(r"-?\d+ -?\d+ -?\d+", hdr['SITELAT']):
-                fail_and_move("Error SITELAT bad match", obj, session)
-                continue
 
-            if not re.match(r"-?\d+ -?\d+ -?\d+", hdr['SITELONG']):
-                fail_and_move("Error SITELONG bad match", obj, session)
-                continue
+def init_worker(settings):
+    globals().update(settings)
 
-            if not re.match(r"-?\d+\.?\d+", hdr['SITEELEV']):
-                fail_and_move("Error SITEELEV bad match", obj, session)
-                continue
 
-            if not re.match(r".+", hdr['TELESCOP']):
-                fail_and_move("Error TELESCOP bad match", obj, session)
-                continue
+def validate_in_worker(obj):
+    '''
+    Pool entry point: validates obj on the worker's own session
+    '''
+
+    return validate_object(worker_session(), obj)
+
+
+def collect(result, obj, session):
+    '''
+    Applies a worker's result on the main session. This is the only place
+    metadata is written, files are failed and errors are recorded.
+    '''
+
+    if result_cache is not None and not result.get('cached'):
+        result_cache.put(obj.checksum, obj.size, obj.name, result['error'], result['metadata'])
+
+    if result['error'] is not None:
+        with metrics.timer('verssa_validation_step_seconds', step='fail'):
+            fail_and_move(result['error'], obj, session)
+        return
+
+    # Finally validate the meta-data
+    with metrics.timer('verssa_validation_step_seconds', step='metadata'):
+        metadata_writer.add(session, obj.path, [('validated', 'true')] + result['metadata'])
+
+
+def validated_paths(session):
+    '''
+    Paths of every object under the validation root that already carries a
+    'validated' AVU, fetched with one paged GenQuery instead of one metadata
+    call per object
+    '''
+
+    query = session.query(Collection.name, DataObject.name) \
+        .filter(Like(Collection.name, VALIDATION_ROOT + "/%")) \
+        .filter(DataObjectMeta.name == 'validated')
+
+    paths = set()
+    for batch in query.get_batches():
+        for row in batch:
+            paths.add(row[Collection.name] + "/" + row[DataObject.name])
+    logger.debug("%d objects already validated" % len(paths))
+    return paths
 
-            if not re.match(r"...", hdr['COUNTRY']):
-                fail_and_move("Error COUNTRY bad match", obj, session)
+
+def candidates(session, scanner):
+    '''
+    Yields every unvalidated .fit/.fits object the scanner returns, leaving
+    out the validation_failed folder
+    '''
+
+    try:
+        validated = validated_paths(session)
+    except Exception as e:
+        logger.exception(e)
+        logger.debug("bulk validated lookup failed, checking objects one at a time")
+        validated = None
+
+    for obj in scanner:
+
+        #   skip validation failed folder
+        if obj.collection == FAILED_DIR or obj.collection.startswith(FAILED_DIR + "/"):
+            continue
+
+        name = obj.name
+        if (not (name.endswith('.fit') or name.endswith('.fits'))):
+            continue
+
+        # If the object already has meta_data
+        if validated is not None:
+            if obj.path in validated:
                 continue
+        elif any(avu.name == 'validated' for avu in session.metadata.get(DataObject, obj.path)):
+            continue
 
-            # Finally validate the meta-data
-            obj.metadata.add('validated', 'true')
-            obj.metadata.add('COUNTRY', str(hdr['COUNTRY']))
-            obj.metadata.add('TELESCOP', str(hdr['TELESCOP']))
-            obj.metadata.add('SITEELEV', str(hdr['SITEELEV']))
-            obj.metadata.add('SITELONG', str(hdr['SITELONG']))
-            obj.metadata.add('SITELAT', str(hdr['SITELAT']))
-            obj.metadata.add('OBJCTDEC', str(hdr['OBJCTDEC']))
-            obj.metadata.add('OBJCTRA', str(hdr['OBJCTRA']))
-            obj.metadata.add('EXPTIME', str(hdr['EXPTIME']))
-            obj.metadata.add('DATE-OBS', str(hdr['DATE-OBS']))
+        yield obj
 
 
-# This function executes and then exits if there are no errors
-send_error_email()
-    
+def claim_file(obj):
+    '''
+    False if another worker holds obj. Leases of files that were handled
+    are left to run out rather than released, so workers that listed the
+    file earlier don't take it again.
+    '''
+
+    return worker_leases is None or len(worker_leases.claim(["validate:" + obj.path])) > 0
+
+
+def release_file(obj):
+    '''
+    Gives up the lease on a file that was claimed but not handled
+    '''
 
+    if worker_leases is not None:
+        worker_leases.release(["validate:" + obj.path])
 
 
+def run_serial(session, scanner, progress):
+    '''
+    Validates candidates one at a time until they run out (returns True) or
+    the time budget does (returns False). progress['last'] is the last file
+    fully handled. A file that raises is logged and skipped, as in
+    run_parallel, so the cursor never stops in front of it.
+    '''
 
+    for obj in candidates(session, scanner):
+        if out_of_time():
+            return False
+        if not claim_file(obj):
+            continue
+        result = cached_result(obj)
+        try:
+            if result is None:
+                result = validate_object(session, obj)
+            collect(result, obj, session)
+        except OutOfTime:
+            release_file(obj)
+            return False
+        except Exception as e:
+            logger.error("could not validate " + obj.path)
+            logger.exception(e)
+        progress['last'] = obj
+    return True
+
+
+def run_parallel(session, scanner, progress, workers, use_processes):
+    '''
+    Fans the header reads and checks out over a pool of workers; results
+    come back here to be applied one at a time. At most two files per
+    worker are in flight, so when the budget runs low only those have to be
+    waited for. Returns True if every candidate was handled.
+    '''
 
+    if use_processes:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                       initargs=(worker_settings(),))
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    complete = True
+    # (position, object before it) of the earliest file a worker gave up on
+    abandoned = None
+    try:
+        with executor:
+            in_flight = {}
+            position = 0
+            for obj in candidates(session, scanner):
+                if out_of_time():
+                    complete = False
+                    break
+                if not claim_file(obj):
+                    continue
+                result = cached_result(obj)
+                if result is not None:
+                    collect(result, obj, session)
+                    progress['last'] = obj
+                    position += 1
+                    continue
+                in_flight[executor.submit(validate_in_worker, obj)] = (position, obj, progress['last'])
+                progress['last'] = obj
+                position += 1
+                if len(in_flight) >= workers * 2:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        abandoned = handle_future(future, in_flight.pop(future), session, abandoned)
+
+            # whatever was handed out is finished before the cursor is saved
+            for future in as_completed(in_flight):
+                abandoned = handle_future(future, in_flight[future], session, abandoned)
+    finally:
+        close_worker_sessions()
+
+    if abandoned is not None:
+        # resume just before the first file that was cut off; the ones after
+        # it that did finish are skipped as already validated
+        progress['last'] = abandoned[1]
+        complete = False
+    return complete
+
+
+def handle_future(future, entry, session, abandoned):
+    position, obj, previous = entry
+    try:
+        result = future.result()
+    except OutOfTime:
+        release_file(obj)
+        if abandoned is None or position < abandoned[0]:
+            return (position, previous)
+        return abandoned
+    except Exception as e:
+        logger.error("could not validate " + obj.path)
+        logger.exception(e)
+        return abandoned
+    try:
+        collect(result, obj, session)
+    except Exception as e:
+        logger.error("could not record the result for " + obj.path)
+        logger.exception(e)
+    return abandoned
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate FITS files under " + VALIDATION_ROOT)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of parallel validation workers (default 1, no pool)")
+    parser.add_argument("--processes", action="store_true",
+                        help="use worker processes instead of threads")
+    parser.add_argument("--full-scan", action="store_true",
+                        help="walk every object instead of only those changed since the last run")
+    parser.add_argument("--integrity", action="store_true",
+                        help="read whole files to verify FITS CHECKSUM/DATASUM and the iRODS checksum")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="read every file even if identical content was checked before")
+    parser.add_argument("--worker", nargs="?", const="", metavar="NAME",
+                        help="split the files with other validators through leases instead of"
+                             " running as the only instance (other hosts too with a PostgreSQL"
+                             " database_url in auth.py)")
+    parser.add_argument("--metrics", metavar="DIR",
+                        help="time each step and iRODS call and write a Prometheus textfile"
+                             " and a JSON summary to DIR")
+    args = parser.parse_args()
+
+    if args.metrics:
+        metrics.enable('validation')
+    if args.worker is not None:
+        # runs of one worker share its leases, so they must not overlap
+        me = singleton.SingleInstance(flavor_id=start_worker(args.worker))
+    else:
+        me = singleton.SingleInstance()  # will sys.exit(-1) if other instance is running
+
+    try:
+        if ("fix_me" in auth.password):
+            logger.debug("you didn't update the password in auth.py")
+            exit(1)
+        # Setup rotating logfile with 3 rotations, each with a maximum filesize of 1MB:
+        logzero.logfile(LOG_FILE, maxBytes=1e6, backupCount=3)
+        logzero.loglevel(logging.DEBUG)
+
+    except Exception as e:
+        logger.exception(e)
+        logger.debug("could not setup so we are exiting")
+        exit(-1)
 
+    logger.debug("Starting program")
+
+    global result_cache, CHECK_INTEGRITY
+    CHECK_INTEGRITY = CHECK_INTEGRITY or args.integrity
+    if not args.no_cache:
+        result_cache = vcache.ValidationCache(vcache.CACHE_FILE, version=cache_version())
+
+    cursor = load_cursor()
+    if cursor is not None:
+        logger.debug("resuming after %s/%s" % (cursor['collection'], cursor['name']))
+
+    with open_session() as session:
+        scanner = scan.DeltaScan(session, VALIDATION_ROOT, scan.Watermarks(WATERMARK_FILE),
+                                 recursive=True, full=True if args.full_scan else None,
+                                 cursor=cursor)
+        progress = {'last': None}
+        complete = False
+        try:
+            with metrics.timer('verssa_phase_seconds', phase='validate'):
+                if args.workers > 1:
+                    complete = run_parallel(session, scanner, progress, args.workers,
+                                            args.processes)
+                else:
+                    complete = run_serial(session, scanner, progress)
+        finally:
+            with metrics.timer('verssa_phase_seconds', phase='metadata flush'):
+                metadata_writer.flush()
+            if complete:
+                scanner.commit()
+                clear_cursor()
+                logger.debug("validation pass finished")
+            elif progress['last'] is not None:
+                save_cursor(scanner.cursor(progress['last']))
+                logger.debug("out of time, will resume after " + progress['last'].path)
+            if result_cache is not None:
+                result_cache.log_stats()
+                result_cache.close()
+
+    if args.metrics:
+        metrics.write(args.metrics)
+
+    # This function executes and then exits if there are no errors
+    send_error_email()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import json
+import threading
+import time
+
+from logzero import logger
+
+import storage
+
+
+CACHE_FILE = "validation-cache.sqlite"
+# verdicts kept before the least recently used are dropped; an entry is a
+# few hundred bytes, so this stays around 20 MB on disk
+MAX_ENTRIES = 100000
+# evicting this many at a time keeps puts from deleting on every insert
+EVICT_CHUNK = 1000
+
+# stands in for the file name inside cached error messages, so a verdict
+# reused for a copy names the copy
+NAME_TOKEN = "<name>"
+
+
+class ValidationCache(object):
+    '''
+    Validation verdicts keyed by content: the iRODS checksum and size of a
+    data object. A frame uploaded again under another name, or moved back
+    out of validation_failed, gets the verdict and header values of its
+    first check without being read again.
+
+    version identifies the rules and metadata keys the verdicts were made
+    with; opening the cache with a different version empties it.
+    '''
+
+    def __init__(self, path=CACHE_FILE, version="", max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = storage.open_sqlite(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS verdicts ("
+                          "checksum TEXT, size INTEGER, error TEXT, metadata TEXT, "
+                          "used_at REAL, PRIMARY KEY (checksum, size))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS verdicts_used ON verdicts (used_at)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+        self._check_version(version)
+        self.count = self.conn.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+
+    def _check_version(self, version):
+        row = self.conn.execute("SELECT value FROM info WHERE key = 'version'").fetchone()
+        if row is not None and row[0] == version:
+            return
+        if row is not None:
+            logger.info("validation rules changed, clearing " + self.path)
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.execute("DELETE FROM verdicts")
+        self.conn.execute("INSERT OR REPLACE INTO info (key, value) VALUES ('version', ?)",
+                          (version,))
+        self.conn.execute("COMMIT")
+
+    def get(self, checksum, size, name):
+        '''
+        The cached result for this content as (error, metadata), with the
+        error message naming name, or None
+        '''
+
+        if not checksum:
+            return None
+        with self.lock:
+            row = self.conn.execute("SELECT error, metadata FROM verdicts "
+                                    "WHERE checksum = ? AND size = ?",
+                                    (checksum, size)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE verdicts SET used_at = ? WHERE checksum = ? AND size = ?",
+                              (time.time(), checksum, size))
+
+        error, metadata = row
+        if error is not None:
+            error = error.replace(NAME_TOKEN, name)
+        if metadata is not None:
+            metadata = [tuple(pair) for pair in json.loads(metadata)]
+        return error, metadata
+
+    def put(self, checksum, size, name, error, metadata):
+        if not checksum:
+            return
+        if error is not None:
+            error = error.replace(name, NAME_TOKEN)
+        with self.lock:
+            cur = self.conn.execute("INSERT OR REPLACE INTO verdicts "
+                                    "(checksum, size, error, metadata, used_at) "
+                                    "VALUES (?, ?, ?, ?, ?)",
+                                    (checksum, size, error,
+                                     None if metadata is None else json.dumps(metadata),
+                                     time.time()))
+            self.count += cur.rowcount
+            if self.count > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        # INSERT OR REPLACE counts replaced rows too, so recount first
+        self.count = self.conn.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+        excess = self.count - self.max_entries
+        if excess <= 0:
+            return
+        excess += min(EVICT_CHUNK, self.max_entries // 10)
+        self.conn.execute("DELETE FROM verdicts WHERE rowid IN (SELECT rowid FROM verdicts "
+                          "ORDER BY used_at LIMIT ?)", (excess,))
+        self.count = self.conn.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+        logger.debug("evicted %d cached verdicts" % excess)
+
+    def log_stats(self):
+        logger.info("validation cache: %d hits, %d misses, %d entries"
+                    % (self.hits, self.misses, self.count))
+
+    def close(self):
+        self.conn.close()